@@ -17,7 +17,7 @@ def index():
     post.save()
 
     post = Post.query.find_one({"name": "test"})
-    total = Post.query.count()
+    total = Post.query.estimated_count()
     return "Total: %d. Post name: %s by author: %s" % (total, post.name,
                                                        post.author)
 
@@ -13,32 +13,200 @@ https://github.com/mitsuhiko/flask-sqlalchemy
 :license: MIT, see LICENSE for more details.
 """
 from __future__ import absolute_import
+import atexit
+import copy_reg
+import json
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, datetime
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from hashlib import md5
+from itertools import count
+from multiprocessing.pool import ThreadPool
+
+from bson import BSON
 from bson.dbref import DBRef
+from bson.objectid import ObjectId
 from bson.son import SON
-from pymongo import Connection
+from pymongo import Connection, helpers
 from pymongo.collection import Collection
 from pymongo.cursor import Cursor
+from pymongo.errors import InvalidOperation, OperationFailure
+from pymongo.master_slave_connection import MasterSlaveConnection
+from pymongo.message import get_more
 from pymongo.son_manipulator import AutoReference, NamespaceInjector
 
-from flask import abort
+from flask import abort, _request_ctx_stack, Response
+from flask.signals import Namespace
+from werkzeug.contrib.cache import BaseCache
+from werkzeug.local import Local, release_local
+
+
+def _link(child, parent, key):
+    """
+    Remember where a nested :class:`AttrDict` lives so that changes made to it
+    can be reported to the documents that contain it. `parent` is either an
+    :class:`AttrDict` or, for list items, the :class:`TrackedList`. Models and
+    documents carrying an `_ns` are saved as references, their changes are
+    their own and are not linked.
+    """
+    if isinstance(child, Model) or '_ns' in child:
+        return
+    object.__setattr__(child, '_AttrDict__parent', parent)
+    object.__setattr__(child, '_AttrDict__key', key)
+
+
+_signals = Namespace()
+
+#: Sent with the application as sender and a :class:`QueryRecord` as
+#: `record` for every operation, when ``MONGODB_RECORD_QUERIES`` is set
+query_executed = _signals.signal('mongoobject-query-executed')
+
+
+class QueryRecord(namedtuple('QueryRecord', 'collection operation spec '
+                                            'duration documents')):
+    """
+    One operation sent to the server: the collection, the operation
+    (`find`, `getmore`, `dereference`, `insert`, `update`, `remove` or
+    `find_and_modify`), the shape of its spec, its duration in seconds and
+    the number of documents it returned or sent, if known.
+    """
+
+
+def _shape(spec):
+    """
+    The shape of a query spec: its keys and operators, without the values
+    """
+    if isinstance(spec, dict):
+        return dict((k, _shape(v)) for k, v in spec.iteritems())
+    if isinstance(spec, list):
+        return [_shape(v) for v in spec[:1]]
+    return '?'
+
+
+class CollectionScanError(OperationFailure):
+    """
+    Raised by queries that scan the whole collection when
+    ``MONGODB_EXPLAIN_AUDIT`` is `'error'`
+    """
+
+
+def _is_collection_scan(explain):
+    """
+    Whether the `explain` output of a query shows a full collection scan
+    """
+    if isinstance(explain, dict):
+        if explain.get('cursor') == 'BasicCursor' or \
+                explain.get('stage') == 'COLLSCAN':
+            return True
+        return any(_is_collection_scan(v) for v in explain.itervalues())
+    if isinstance(explain, list):
+        return any(_is_collection_scan(v) for v in explain)
+    return False
+
+
+def _index_args(index):
+    """
+    The key and the options of :meth:`Collection.ensure_index` for an entry
+    of :attr:`Model.__indexes__`
+    """
+    if isinstance(index, dict):
+        options = dict(index)
+        key = options.pop('key')
+    else:
+        key, options = index, {}
+    if isinstance(key, basestring):
+        key = [(key, 1)]
+    if 'expire_after' in options:
+        options['expireAfterSeconds'] = options.pop('expire_after')
+    # building the index doesn't lock the database
+    options.setdefault('background', True)
+    return key, options
+
+
+def _lazy_wrap(value, parent, key):
+    """
+    Wrap a raw nested value the way :class:`LazyAttrDict` expects it. Values
+    that are already wrapped are returned untouched so callers can compare
+    identity to decide whether the wrapped value needs to be cached.
+    """
+    if isinstance(value, (AttrDict, TrackedList)):
+        return value
+    if isinstance(value, dict):
+        value = LazyAttrDict(value)
+        _link(value, parent, key)
+    elif isinstance(value, list):
+        value = LazyList(value, (parent, key))
+    return value
+
+
+def _plain(value):
+    """
+    `value` with the raw dicts and lists it holds, such as the
+    :class:`bson.son.SON` left unwrapped in lazy documents, copied to plain
+    ones, which always pickle
+    """
+    if isinstance(value, (AttrDict, TrackedList)):
+        return value
+    if isinstance(value, dict):
+        return dict((k, _plain(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
 
 class AttrDict(dict):
     """
     Base object that represents a MongoDB document. The object will behave both
     like a dict `x['y']` and like an object `x.y`
+
+    When :attr:`__lazy__` is set, nested dicts and lists are stored as they
+    come from the database and only wrapped the first time they are accessed
+    through `x.y` or `x['y']`. The wrapped value is cached in place, so later
+    accesses are plain dict lookups. Note that `items()`, `values()` and
+    iteration still see the raw, unwrapped values.
+
+    Once :meth:`mark_clean` has been called, every key set or deleted, through
+    `x.y`, `x['y']` or the dict methods such as `update` or `pop`, at any
+    depth, is recorded as a dotted path and :meth:`get_changes` turns them
+    into `$set`/`$unset` operators. A change anywhere inside a list, including
+    `append` and the other list methods, marks the whole list, see
+    :class:`TrackedList`. Changes made to values stored in some other way
+    can't be seen, use :meth:`mark_dirty` for those.
     """
+    #: wrap nested values on first access instead of on construction
+    __lazy__ = False
+
+    # slots rather than an instance dict: nested documents are many, and
+    # most of them never get linked or tracked.
+    # parent and key of a nested AttrDict, see :func:`_link`, and the
+    # changed paths since :meth:`mark_clean`, `None` when not tracking
+    __slots__ = ('_AttrDict__parent', '_AttrDict__key', '_AttrDict__changes')
+
     def __init__(self, initial=None, **kwargs):
+        object.__setattr__(self, '_AttrDict__parent', None)
+        object.__setattr__(self, '_AttrDict__changes', None)
+        if self.__lazy__:
+            # nothing to convert up front, let the dict constructor copy
+            super(AttrDict, self).__init__()
+            if initial:
+                dict.update(self, initial)
+            dict.update(self, kwargs)
+            return
         # Make sure that during initialization, that we recursively apply
         # AttrDict.  Maybe this could be better done with the builtin
         # defaultdict?
         if initial:
             for key, value in initial.iteritems():
                 # Can't just say self[k] = v here b/c of recursion.
-                self.__setitem__(key, value)
+                self.__store(key, value)
         # Process the other arguments (assume they are also default values).
         # This is the same behavior as the regular dict constructor.
         for key, value in kwargs.iteritems():
-            self.__setitem__(key, value)
+            self.__store(key, value)
 
         super(AttrDict, self).__init__()
 
@@ -48,8 +216,11 @@ class AttrDict(dict):
     # a KeyError.  we don't ever want __getattr__ to raise a KeyError, so we
     # 'translate' them below:
     def __getattr__(self, attr):
+        if attr in AttrDict.__slots__:
+            # built without __init__, by copy or pickle
+            return None
         try:
-            return super(AttrDict, self).__getitem__(attr)
+            return self[attr]
         except KeyError as excn:
             raise AttributeError(excn)
 
@@ -62,113 +233,1779 @@ class AttrDict(dict):
 
     def __delattr__(self, key):
         try:
-            return super(AttrDict, self).__delitem__(key)
+            return self.__delitem__(key)
         except KeyError as excn:
             raise AttributeError(excn)
 
+    def __getitem__(self, key):
+        value = super(AttrDict, self).__getitem__(key)
+        if self.__lazy__:
+            wrapped = _lazy_wrap(value, self, key)
+            if wrapped is not value:
+                super(AttrDict, self).__setitem__(key, wrapped)
+            return wrapped
+        return value
+
     def __setitem__(self, key, value):
+        self.__store(key, value)
+        self.mark_dirty(key)
+
+    def __delitem__(self, key):
+        super(AttrDict, self).__delitem__(key)
+        self.mark_dirty(key)
+
+    def __store(self, key, value):
+        if self.__lazy__:
+            return super(AttrDict, self).__setitem__(key, value)
         new_value = value
         # if the nested attribute is not an :class: `AttrDict` already,
         # convert it to one
-        if isinstance(value, dict) and not isinstance(value, AttrDict):
-            new_value = AttrDict(value)
+        if isinstance(value, dict):
+            if not isinstance(value, AttrDict):
+                new_value = AttrDict(value)
+            _link(new_value, self, key)
         elif isinstance(value, list):
-            for i, item in enumerate(value):
-                if isinstance(item, dict) and not isinstance(item, AttrDict):
-                    value[i] = AttrDict(item)
-                else:
-                    value[i] = item
+            new_value = TrackedList(value, (self, key))
         return super(AttrDict, self).__setitem__(key, new_value)
 
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super(AttrDict, self).pop(key, *default)
+        value = super(AttrDict, self).pop(key)
+        self.mark_dirty(key)
+        return value
+
+    def popitem(self):
+        key, value = super(AttrDict, self).popitem()
+        self.mark_dirty(key)
+        return key, value
+
+    def clear(self):
+        keys = self.keys()
+        super(AttrDict, self).clear()
+        for key in keys:
+            self.mark_dirty(key)
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', None) or {})
+        state['_AttrDict__parent'] = self.__parent
+        state['_AttrDict__key'] = self.__key
+        state['_AttrDict__changes'] = self.__changes
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.iteritems():
+            object.__setattr__(self, key, value)
+
+    def __reduce_ex__(self, protocol):
+        # raw values of a lazy document may not pickle, see :func:`_plain`
+        return (copy_reg.__newobj__, (type(self),), self.__getstate__(), None,
+                ((k, _plain(v)) for k, v in dict.iteritems(self)))
+
+    def _merge(self, document):
+        """
+        Add the fields of `document` that this one doesn't have yet, without
+        recording them as changes
+        """
+        for key, value in document.iteritems():
+            if key not in self:
+                self.__store(key, value)
+
+    def mark_clean(self):
+        """
+        Forget about previous changes and start tracking new ones, this is
+        called whenever a document is loaded from or written to the database.
+        """
+        object.__setattr__(self, '_AttrDict__changes', set())
+
+    def mark_dirty(self, path):
+        """
+        Record that `path` changed, on this document and on every tracking
+        document it is nested in.
+        """
+        node = self
+        path = [path]
+        while node is not None:
+            if node.__changes is not None:
+                node.__changes.add('.'.join(reversed(path)))
+            parent = node.__parent
+            if isinstance(parent, TrackedList):
+                # list items can't be addressed reliably, replace the list
+                parent._changed()
+                return
+            if parent is not None:
+                path.append(node.__key)
+            node = parent
+
+    def get_changes(self):
+        """
+        Return the `$set`/`$unset` operators for the changes recorded since
+        :meth:`mark_clean`, an empty dict if nothing changed or `None` if
+        this document isn't tracking changes yet.
+        """
+        if self.__changes is None:
+            return None
+        changes = {}
+        # writing both `a` and `a.b` is a conflict for MongoDB, the parent
+        # already carries the change of its children
+        for path in sorted(self.__changes):
+            parts = path.split('.')
+            if any('.'.join(parts[:i]) in self.__changes
+                   for i in xrange(1, len(parts))):
+                continue
+            value = self
+            for part in parts:
+                if not isinstance(value, dict) or part not in value:
+                    changes.setdefault('$unset', {})[path] = 1
+                    break
+                value = dict.__getitem__(value, part)
+            else:
+                changes.setdefault('$set', {})[path] = value
+        return changes
+
+
+class LazyAttrDict(AttrDict):
+    """
+    :class:`AttrDict` that wraps its nested values on first access. This is
+    what nested documents of a lazy :class:`AttrDict` are turned into.
+    """
+    __slots__ = ()
+    __lazy__ = True
+
+
+class TrackedList(list):
+    """
+    A list stored in an :class:`AttrDict`, whose methods that change it
+    mark it as changed in the document it is stored in. Dicts put in it are
+    turned into :class:`AttrDict` and lists into :class:`TrackedList`.
+    """
+    #: (document, key) this list is stored under, or (list, `None`) when it
+    #: is nested in another list
+    __slots__ = ('owner',)
+
+    def __init__(self, items=(), owner=(None, None)):
+        self.owner = owner
+        super(TrackedList, self).__init__(self._wrap(item) for item in items)
+
+    def _wrap(self, item):
+        if isinstance(item, dict):
+            if not isinstance(item, AttrDict):
+                item = AttrDict(item)
+            _link(item, self, None)
+        elif isinstance(item, TrackedList):
+            item.owner = (self, None)
+        elif isinstance(item, list):
+            item = TrackedList(item, (self, None))
+        return item
+
+    def __getattr__(self, attr):
+        if attr == 'owner':
+            # built without __init__, by copy or pickle
+            return (None, None)
+        raise AttributeError(attr)
+
+    def __getstate__(self):
+        return self.owner
+
+    def __setstate__(self, owner):
+        self.owner = owner
+
+    def __reduce_ex__(self, protocol):
+        # raw items of a lazy list may not pickle, see :func:`_plain`
+        return (copy_reg.__newobj__, (type(self),), self.__getstate__(),
+                (_plain(item) for item in list.__iter__(self)), None)
+
+    def _changed(self):
+        parent, key = self.owner
+        if isinstance(parent, TrackedList):
+            parent._changed()
+        elif parent is not None:
+            parent.mark_dirty(key)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [self._wrap(item) for item in value]
+        else:
+            value = self._wrap(value)
+        super(TrackedList, self).__setitem__(index, value)
+        self._changed()
+
+    def __delitem__(self, index):
+        super(TrackedList, self).__delitem__(index)
+        self._changed()
+
+    def __setslice__(self, i, j, items):
+        super(TrackedList, self).__setslice__(
+            i, j, [self._wrap(item) for item in items])
+        self._changed()
+
+    def __delslice__(self, i, j):
+        super(TrackedList, self).__delslice__(i, j)
+        self._changed()
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __imul__(self, n):
+        super(TrackedList, self).__imul__(n)
+        self._changed()
+        return self
+
+    def append(self, item):
+        super(TrackedList, self).append(self._wrap(item))
+        self._changed()
+
+    def extend(self, items):
+        super(TrackedList, self).extend(self._wrap(item) for item in items)
+        self._changed()
+
+    def insert(self, index, item):
+        super(TrackedList, self).insert(index, self._wrap(item))
+        self._changed()
+
+    def remove(self, item):
+        super(TrackedList, self).remove(item)
+        self._changed()
+
+    def pop(self, *index):
+        item = super(TrackedList, self).pop(*index)
+        self._changed()
+        return item
+
+    def sort(self, *args, **kwargs):
+        super(TrackedList, self).sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        super(TrackedList, self).reverse()
+        self._changed()
+
+
+class LazyList(TrackedList):
+    """
+    A list coming from a lazy :class:`AttrDict`. Items are wrapped with
+    :class:`LazyAttrDict` on first access and cached in place.
+    """
+    __slots__ = ()
+
+    def __init__(self, items=(), owner=(None, None)):
+        self.owner = owner
+        list.__init__(self, items)
+
+    def _wrap(self, item):
+        # wrapped on first access
+        return item
+
+    def __getitem__(self, index):
+        item = super(LazyList, self).__getitem__(index)
+        if isinstance(index, slice):
+            return LazyList(item)
+        wrapped = _lazy_wrap(item, self, None)
+        if wrapped is not item:
+            list.__setitem__(self, index, wrapped)
+        return wrapped
+
+    def __getslice__(self, i, j):
+        return LazyList(super(LazyList, self).__getslice__(i, j))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class CompactDocument(object):
+    """
+    Document with a fixed set of fields kept in `__slots__` instead of a
+    `dict`, which takes several times less memory than an :class:`AttrDict`.
+    It behaves both like a dict `x['y']` and like an object `x.y`. Fields
+    that are not declared are kept aside in a small dict so that nothing is
+    lost when the document is saved back.
+
+    Subclasses are generated from a schema by :func:`compile_schema`.
+    """
+    __slots__ = ('_extra',)
+    #: declared field -> compiled class of its embedded documents, a list of
+    #: it for lists of embedded documents, or `None`
+    __fields__ = {}
+
+    def __init__(self, initial=None, **kwargs):
+        object.__setattr__(self, '_extra', None)
+        if initial:
+            for key, value in initial.iteritems():
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def _convert(self, key, value):
+        kind = self.__fields__[key]
+        if kind is None:
+            return value
+        if isinstance(kind, list):
+            if isinstance(value, list):
+                return [kind[0](item) if isinstance(item, dict) else item
+                        for item in value]
+        elif isinstance(value, dict):
+            return kind(value)
+        return value
+
+    def __getattr__(self, attr):
+        # only called for names that are not slots, or empty slots
+        if attr == '_extra':
+            raise AttributeError(attr)
+        if self._extra is not None and attr in self._extra:
+            return self._extra[attr]
+        raise AttributeError(attr)
+
+    def __setattr__(self, attr, value):
+        self[attr] = value
+
+    def __delattr__(self, attr):
+        try:
+            del self[attr]
+        except KeyError as excn:
+            raise AttributeError(excn)
+
+    def __getitem__(self, key):
+        if key in self.__fields__:
+            try:
+                return object.__getattribute__(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.__fields__:
+            object.__setattr__(self, key, self._convert(key, value))
+        else:
+            if self._extra is None:
+                object.__setattr__(self, '_extra', {})
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.__fields__:
+            try:
+                object.__delattr__(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [key for key in self.__fields__ if key in self]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, CompactDocument)):
+            return dict(self.iteritems()) == dict(other.iteritems())
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    def to_son(self):
+        """
+        Return the document as :class:`bson.son.SON`, ready to be encoded
+        """
+        def convert(value):
+            if isinstance(value, CompactDocument):
+                return value.to_son()
+            elif isinstance(value, list):
+                return [convert(item) for item in value]
+            return value
+
+        son = SON()
+        if "_id" in self:
+            son["_id"] = self["_id"]
+        for key, value in self.iteritems():
+            if key != "_id":
+                son[key] = convert(value)
+        return son
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.iteritems()))
+
+
+def compile_schema(name, schema, base=CompactDocument, **attrs):
+    """
+    Generate a `base` subclass named `name` with one slot per field of
+    `schema`. `schema` maps field names to their type, which is only
+    documentation, to a nested schema for embedded documents, or to a list
+    holding a nested schema for lists of embedded documents::
+
+        {"title": unicode,
+         "author": {"name": unicode, "email": unicode},
+         "comments": [{"text": unicode, "votes": int}]}
+
+    Fields which are not valid identifiers or clash with the attributes of
+    `base` are kept with the undeclared ones.
+    """
+    fields = {}
+    for key, kind in schema.iteritems():
+        if isinstance(kind, dict):
+            fields[key] = compile_schema('%s_%s' % (name, key), kind)
+        elif isinstance(kind, list) and kind and isinstance(kind[0], dict):
+            fields[key] = [compile_schema('%s_%s' % (name, key), kind[0])]
+        else:
+            fields[key] = None
+    for key in list(fields):
+        if not _identifier.match(key) or hasattr(base, key):
+            del fields[key]
+    attrs.update(__slots__=tuple(fields), __fields__=fields)
+    return type(name, (base,), attrs)
+
+
+class LRUCache(BaseCache):
+    """
+    In-process cache with the interface of the `werkzeug.contrib.cache`
+    backends, which keeps at most `threshold` items and evicts the least
+    recently used one first. A `timeout` of `0` means the item never expires.
+    """
+    def __init__(self, threshold=1000, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.threshold = threshold
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return None
+            if expires and expires < time.time():
+                return None
+            self._items[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (timeout and time.time() + timeout, value)
+            while len(self._items) > self.threshold:
+                self._items.popitem(last=False)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if key in self._items:
+                return
+        self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+def _normalize(value):
+    """
+    Turn a query spec into something whose `repr` doesn't depend on the
+    order keys were inserted into plain dicts
+    """
+    if isinstance(value, SON):
+        return ('SON', [(k, _normalize(v)) for k, v in value.iteritems()])
+    if isinstance(value, dict):
+        return sorted((k, _normalize(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+class QueryCache(object):
+    """
+    Read-through cache of query results on top of a `werkzeug.contrib.cache`
+    backend: :class:`LRUCache` in-process, or a shared one such as
+    `MemcachedCache` or `RedisCache` (`SimpleCache` makes a good local
+    stand-in for those in development).
+
+    Results are cached as the BSON documents the server sent, so that every
+    hit builds fresh models and resolves references again. Entries are keyed
+    on a generation token per collection: :meth:`invalidate` replaces the
+    token, and the previous entries are never read again and expire on their
+    own, which works the same for every backend.
+    """
+    #: results with more documents than this are not cached
+    max_documents = 1000
+    #: seconds a generation token is kept, 30 days is the longest relative
+    #: timeout memcached accepts
+    generation_timeout = 30 * 24 * 3600
+
+    _tokens = count()
+
+    def __init__(self, backend, prefix='flask-mongoobject'):
+        self.backend = backend
+        self.prefix = prefix
+
+    def _generation(self, collection):
+        key = '%s:generation:%s' % (self.prefix, collection)
+        generation = self.backend.get(key)
+        if generation is None:
+            generation = self._new_generation(collection)
+        return generation
+
+    def _new_generation(self, collection):
+        generation = '%s.%d.%d' % (time.time(), os.getpid(),
+                                   next(self._tokens))
+        self.backend.set('%s:generation:%s' % (self.prefix, collection),
+                         generation, self.generation_timeout)
+        return generation
+
+    def key(self, collection, params):
+        digest = md5(repr(_normalize(params))).hexdigest()
+        return '%s:%s:%s:%s' % (self.prefix, collection,
+                                self._generation(collection), digest)
+
+    def get(self, collection, params, key=None):
+        """
+        Return the list of documents cached for `params`, or `None`. `key`
+        is the :meth:`key` of `params` if it is known already.
+        """
+        cached = self.backend.get(key or self.key(collection, params))
+        if cached is not None:
+            return [BSON(raw).to_dict() for raw in cached]
+
+    def set(self, collection, params, documents, timeout=None, key=None):
+        """
+        Cache `documents`, dicts or already encoded :class:`bson.BSON`, as
+        the results for `params`. Pass the `key` computed before the query
+        was sent, so that results read while the collection was invalidated
+        go under the generation they came from and are never served.
+        """
+        self.backend.set(key or self.key(collection, params),
+                         [isinstance(document, BSON) and document or
+                          BSON.encode(document) for document in documents],
+                         timeout)
+
+    def invalidate(self, collection):
+        """
+        Forget all the results cached for `collection`
+        """
+        self._new_generation(collection)
+
+
+def _load(cls, data, fields=None):
+    """
+    Build a `cls` instance from a document fresh out of the database, `fields`
+    being the projection it was loaded with if any
+    """
+    item = cls(data)
+    if isinstance(item, AttrDict):
+        item.mark_clean()
+    if fields is not None and isinstance(item, Model):
+        item.mark_partial(fields)
+    return item
+
+
+def _copy_tree(value):
+    """
+    Copy the dicts and lists of a document fresh out of the database
+    """
+    if isinstance(value, dict):
+        return dict((k, _copy_tree(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_copy_tree(v) for v in value]
+    return value
+
+
+def _path_tree(paths):
+    """
+    Nest dotted `paths`, such as `'comments.author'`, into a tree of dicts,
+    `{'comments': {'author': {}}}`
+    """
+    tree = {}
+    for path in paths:
+        node = tree
+        for key in path.split('.'):
+            node = node.setdefault(key, {})
+    return tree
+
+
+def _merge_trees(tree, other):
+    for key, subtree in other.iteritems():
+        if key in tree:
+            _merge_trees(tree[key], subtree)
+        else:
+            tree[key] = subtree
+    return tree
+
+
+def _union_trees(tree, other):
+    """
+    `tree` with the paths of `other` added, without changing either of them.
+    `tree` itself when it already has all of them.
+    """
+    union = tree
+    for key, subtree in other.iteritems():
+        if key in tree:
+            subtree = _union_trees(tree[key], subtree)
+            if subtree is tree[key]:
+                continue
+        if union is tree:
+            union = dict(tree)
+        union[key] = subtree
+    return union
+
+
+def _reference_tree(value):
+    """
+    The tree, see :func:`_path_tree`, of the paths of `value` that hold
+    DBRefs or documents with an `_ns`, `None` when there are none. Lists
+    don't count in the paths.
+    """
+    if isinstance(value, DBRef):
+        return {}
+    if isinstance(value, list):
+        tree = None
+        for item in value:
+            subtree = _reference_tree(item)
+            if subtree is not None:
+                tree = _merge_trees(tree or {}, subtree)
+        return tree
+    if isinstance(value, dict) and not isinstance(value, AttrDict):
+        tree = {}
+        for key, item in value.iteritems():
+            subtree = _reference_tree(item)
+            if subtree is not None:
+                tree[key] = subtree
+        if tree or value.get('_ns', None):
+            return tree
+    return None
+
+
+class _Resolved(dict):
+    """
+    A document whose references :meth:`AutoReferenceObject.prefetch` already
+    resolved, which :meth:`AutoReferenceObject.transform_outgoing` leaves as
+    they are. `tree` holds the paths it still has to visit.
+    """
+    def __init__(self, document, tree=None):
+        dict.__init__(self, document)
+        self.tree = tree
+
+
+class MongoCursor(Cursor):
+    """
+    A cursor that will return an instance of :attr:`as_class` instead of
+    `dict`
+
+    If the collection is bound to a :class:`MongoObject` with auto reference
+    enabled, all the DBRefs of a fetched batch are resolved together before
+    the documents are handed out, see :meth:`AutoReferenceObject.prefetch`.
+
+    Models loaded with a `fields` projection are partial, see
+    :attr:`Model.is_partial`.
+
+    When the model has a query cache, the results of the query are looked up
+    in it before the query is sent, and stored in it once the cursor has
+    been read to the end, see :class:`QueryCache`.
+
+    `autoref_depth` and `autoref_fields` are passed on to
+    :meth:`AutoReferenceObject.prefetch`.
+    """
+    def __init__(self, *args, **kwargs):
+        self.as_class = kwargs.pop('as_class')
+        self.autoref_depth = kwargs.pop('autoref_depth', None)
+        self.autoref_fields = kwargs.pop('autoref_fields', None)
+        self.manipulate = kwargs.get('manipulate', True)
+        # Cursor(collection, spec, fields, ...)
+        self.fields = args[2] if len(args) > 2 else kwargs.get('fields')
+        self.cached = False
+        self._captured = None
+        self._cache_key = None
+        super(MongoCursor, self).__init__(*args, **kwargs)
+
+    def _cache_params(self):
+        """
+        What identifies the results of this cursor in the query cache, or
+        `None` if they shouldn't be cached
+        """
+        if self._Cursor__explain or self._Cursor__tailable or \
+                self._Cursor__hint:
+            return None
+        return (self._Cursor__spec, self._Cursor__fields,
+                self._Cursor__ordering, self._Cursor__skip,
+                self._Cursor__limit)
+
+    @property
+    def resolver(self):
+        if isinstance(self.collection, BaseQuery) and self.manipulate and \
+                self.collection.mongo is not None:
+            return self.collection.mongo.autoref
+
+    @property
+    def mongo(self):
+        if isinstance(self.collection, BaseQuery):
+            return self.collection.mongo
+
+    def _refresh(self):
+        # pymongo keeps the fetched batch in a private attribute, we peek at
+        # it so that references get resolved for the whole batch at once
+        empty = not self._Cursor__data
+        if empty and self._Cursor__id is None and not self._Cursor__killed:
+            self._read_cache()
+            if not self.cached:
+                self._audit()
+        mongo = self.mongo
+        if mongo is not None and mongo.instrumented and empty and \
+                not self._Cursor__killed:
+            operation = self._Cursor__id is None and 'find' or 'getmore'
+            start = time.time()
+            length = super(MongoCursor, self)._refresh()
+            mongo.record(self.collection.name, operation,
+                         self._Cursor__spec, time.time() - start, length)
+        else:
+            length = super(MongoCursor, self)._refresh()
+        if empty and self._captured is not None:
+            self._capture()
+        if empty and length:
+            resolver = self.resolver
+            if resolver is not None:
+                trees = resolver.prefetch(self._Cursor__data,
+                                          self.collection.name,
+                                          self.autoref_depth,
+                                          self.autoref_fields,
+                                          self.collection.database)
+                self._Cursor__data = [
+                    _Resolved(document, tree) for document, tree
+                    in zip(self._Cursor__data, trees)]
+        return length
+
+    def _read_cache(self):
+        """
+        Before the query is sent, fill the cursor from the query cache if
+        the results are there, or get ready to store them
+        """
+        if not isinstance(self.collection, BaseQuery):
+            return
+        cache = self.collection.cache
+        params = cache is not None and self._cache_params()
+        if not params:
+            return
+        # the generation of when the query is sent, see :meth:`_capture`
+        self._cache_key = cache.key(self.collection.name, params)
+        documents = cache.get(self.collection.name, params, self._cache_key)
+        if documents is None:
+            self._captured = []
+        else:
+            self.cached = True
+            self._Cursor__data = documents
+            self._Cursor__killed = True
+
+    def _audit(self):
+        """
+        Explain the query before it is sent, once per shape of query, to
+        warn about or refuse full collection scans, see
+        ``MONGODB_EXPLAIN_AUDIT``
+        """
+        mongo = self.mongo
+        if mongo is None or not mongo.app.config['MONGODB_EXPLAIN_AUDIT'] \
+                or not self._Cursor__spec or self._Cursor__explain:
+            return
+        shape = (self.collection.name, repr(_normalize(_shape(
+            self._Cursor__spec))), repr(self._Cursor__ordering))
+        if shape in mongo.audited:
+            return
+        mongo.audited.add(shape)
+        if not _is_collection_scan(self.explain()):
+            return
+        message = 'query on %s scans the whole collection: %r' % (
+            self.collection.name, _shape(self._Cursor__spec))
+        if mongo.app.config['MONGODB_EXPLAIN_AUDIT'] == 'error':
+            raise CollectionScanError(message)
+        mongo.app.logger.warning(message)
+
+    def _capture(self):
+        cache = self.collection.cache
+        # encoded right away, before prefetch resolves references in place
+        self._captured.extend(BSON.encode(document)
+                              for document in self._Cursor__data)
+        if len(self._captured) > cache.max_documents:
+            self._captured = None
+        elif self._Cursor__killed or not self._Cursor__id:
+            # the server has nothing more for us
+            cache.set(self.collection.name, self._cache_params(),
+                      self._captured, self.collection.cache_timeout,
+                      self._cache_key)
+            self._captured = None
+
+    def iter_batches(self, size=100):
+        """
+        Yield lists of at most `size` models, one list per batch the server
+        sends back, which asks the server for batches of `size` documents
+        """
+        self.batch_size(size)
+        batch = []
+        for item in self:
+            batch.append(item)
+            if len(batch) >= size or not self._Cursor__data:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def iter_raw(self):
+        """
+        Yield the documents with their references resolved, but without
+        turning them into :attr:`as_class` instances
+        """
+        while True:
+            try:
+                yield super(MongoCursor, self).next()
+            except StopIteration:
+                return
+
+    def next(self):
+        data = super(MongoCursor, self).next()
+        mongo = self.mongo
+        if mongo is None or not mongo.instrumented:
+            return _load(self.as_class, data, self.fields)
+        start = time.time()
+        item = _load(self.as_class, data, self.fields)
+        mongo.add_timing('conversion', time.time() - start)
+        return item
+
+    def __getitem__(self, index):
+        item = super(MongoCursor, self).__getitem__(index)
+        if isinstance(index, slice):
+            return item
+        else:
+            return _load(self.as_class, item, self.fields)
+
+
+class AutoReferenceObject(AutoReference):
+    """
+    Transparently reference and de-reference already saved embedded objects.
+
+    This manipulator should probably only be used when the NamespaceInjector is
+    also being used, otherwise it doesn't make too much sense - documents can
+    only be auto-referenced if they have an `_ns` field.
+
+    If the document should be an instance of a :class:`flaskext.mongoobject.Model`
+    then we will transform it into a model's instance too.
+
+    References are resolved level by level, a reference to a document it is
+    nested in is left as a DBRef so that circular references never loop,
+    and how deep resolution goes and which fields are loaded can be limited,
+    see :meth:`prefetch`.
+
+    References to models bound to another database, see
+    :attr:`Model.__bind__`, are saved with the name of that database and
+    resolved against the connection of their bind.
+
+    Only the paths of a document that can hold references or mapped
+    documents are visited, the rest of it is left untouched, see
+    :meth:`reference_tree`.
+    """
+    #: documents of a collection in a row that add no path to its inferred
+    #: reference tree, after which the tree is reused and only one document
+    #: in this many is still looked through
+    inferred_sample = 100
+
+    def __init__(self, mongo):
+        self.mongo = mongo
+        # declared reference paths of each model, as trees
+        self._trees = {}
+        # collection -> (tree, documents in a row that added no path to it,
+        # documents seen) for the collections that don't declare their paths
+        self._inferred = {}
+
+    @property
+    def db(self):
+        return self.mongo.session
+
+    def reference_tree(self, document, collection=None):
+        """
+        The paths of `document`, from `collection`, that can hold references
+        or mapped documents, as a tree, see :func:`_path_tree`. They are the
+        :attr:`Model.__references__` of the model mapped to `collection`
+        when it declares them.
+
+        Otherwise they are those found in the documents of `collection` so
+        far. Once :attr:`inferred_sample` documents in a row added nothing to
+        them, documents are only looked through now and then, so references
+        in paths that only a few documents use should be declared.
+        """
+        model = self.mongo.mapper.get(collection, None)
+        references = getattr(model, '__references__', None)
+        if references is not None:
+            try:
+                return self._trees[model]
+            except KeyError:
+                tree = self._trees[model] = _path_tree(references)
+                return tree
+        if collection is None:
+            return _reference_tree(document) or {}
+        tree, unchanged, seen = self._inferred.get(collection, ({}, 0, 0))
+        seen += 1
+        if unchanged < self.inferred_sample or \
+                not seen % self.inferred_sample:
+            union = _union_trees(tree, _reference_tree(document) or {})
+            unchanged = union is tree and unchanged + 1 or 0
+            tree = union
+        # trees are never changed once stored, other threads may be using them
+        self._inferred[collection] = (tree, unchanged, seen)
+        return tree
+
+    def prefetch(self, documents, collection=None, depth=None, fields=None,
+                 database=None):
+        """
+        Resolve the DBRefs of `documents` in place, with one `$in` query per
+        referenced collection and level of references instead of one query
+        per reference, and turn the resolved documents into models.
+
+        `documents` come from `collection`. `depth` is how many levels of
+        references are resolved, `None` for all of them. `fields` maps the
+        path of a reference, such as `'author'` or `'comments.author'`, to
+        the only fields to load for it, which gives partial models.
+        `database` is the database `documents` come from, the one of the
+        default bind if not given.
+
+        A reference to a document it is nested in is left as it is, and so
+        are references to a database that no bind points to.
+
+        Return the :meth:`reference_tree` of each document.
+        """
+        fields = fields or {}
+        identity_map = self.mongo.identity_map
+        instrumented = self.mongo.instrumented
+        found = {}
+        loaded = []
+        if database is None:
+            database = self.db
+        trees = [self.reference_tree(document, collection)
+                 for document in documents]
+        level = [(document, '',
+                  frozenset([(document.get('_ns', collection),
+                              document.get('_id'))]), database, tree)
+                 for document, tree in zip(documents, trees)]
+        while level and (depth is None or depth > 0):
+            if depth is not None:
+                depth -= 1
+            slots = []
+            for document, path, ancestors, database, tree in level:
+                self._collect(document, None, None, path, ancestors, fields,
+                              slots, database, tree)
+
+            # documents already loaded during this request don't need a query
+            wanted = {}
+            databases = {}
+            for holder, key, ref, db, path, ancestors, only in slots:
+                if (db.name, ref.collection, ref.id, only) in found:
+                    continue
+                if identity_map is not None and \
+                        (db.name, ref.collection, ref.id) in identity_map:
+                    found[(db.name, ref.collection, ref.id, only)] = \
+                        identity_map[(db.name, ref.collection, ref.id)]
+                else:
+                    databases[db.name] = db
+                    wanted.setdefault((db.name, ref.collection, only),
+                                      set()).add(ref.id)
+
+            for (db_name, name, only), ids in wanted.iteritems():
+                spec = {"_id": {"$in": list(ids)}}
+                start = instrumented and time.time()
+                # raw documents, their references are resolved right here
+                result = list(databases[db_name][name].find(
+                    spec, fields=only and list(only) or None,
+                    manipulate=False))
+                if instrumented:
+                    self.mongo.record(name, 'dereference', spec,
+                                      time.time() - start, len(result))
+                for id in ids:
+                    found[(db_name, name, id, only)] = None
+                for document in result:
+                    found[(db_name, name, document["_id"], only)] = document
+
+            level = []
+            for holder, key, ref, db, path, ancestors, only in slots:
+                value = found[(db.name, ref.collection, ref.id, only)]
+                if isinstance(value, dict) and \
+                        not isinstance(value, AttrDict):
+                    # every reference gets its own copy to resolve further
+                    value = _copy_tree(value)
+                    loaded.append((holder, key, value, db, ref.collection,
+                                   only))
+                    level.append((value, path,
+                                  ancestors | set([(ref.collection, ref.id)]),
+                                  db, self.reference_tree(value,
+                                                          ref.collection)))
+                holder[key] = value
+
+        # the deepest documents first, so that their models end up in the
+        # documents they are nested in
+        for holder, key, value, db, name, only in reversed(loaded):
+            holder[key] = self._load(db, name, value, only)
+        return trees
+
+    def _collect(self, value, holder, key, path, ancestors, fields, slots,
+                 database, tree):
+        if isinstance(value, DBRef):
+            db = self._database(value, database)
+            if db is not None and \
+                    (value.collection, value.id) not in ancestors:
+                only = fields.get(path)
+                if only is not None:
+                    only = tuple(sorted(set(only) | set(['_id', '_ns'])))
+                slots.append((holder, key, value, db, path, ancestors, only))
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                self._collect(item, value, i, path, ancestors, fields, slots,
+                              database, tree)
+        elif isinstance(value, dict) and not isinstance(value, AttrDict):
+            for k, subtree in tree.iteritems():
+                if k in value:
+                    self._collect(value[k], value, k,
+                                  path and path + '.' + k or k, ancestors,
+                                  fields, slots, database, subtree)
+
+    def _database(self, ref, database):
+        """
+        The database `ref` points to, from a document of `database`: the
+        one of the bind of the model mapped to its collection, or else the
+        one it names
+        """
+        model = self.mongo.mapper.get(ref.collection, None)
+        if model is not None:
+            return self.mongo.get_session(model.__bind__)
+        if ref.database is None or ref.database == database.name:
+            return database
+        return self.mongo.find_session(ref.database)
+
+    def _load(self, database, collection, document, fields=None):
+        """
+        Turn a resolved `document` into an instance of the model mapped to
+        `collection`, if any, sharing it through the identity map
+        """
+        cls = self.mongo.mapper.get(collection, None)
+        if cls is None:
+            return document
+        item = _load(cls.schema_class() or cls, document,
+                     fields and list(fields))
+        # partial documents never go into the identity map
+        identity_map = self.mongo.identity_map
+        if identity_map is None or fields is not None or \
+                document.get('_id', None) is None:
+            return item
+        return identity_map.setdefault(
+            (database.name, collection, document['_id']), item)
+
+    def transform_incoming(self, son, collection):
+        store_ns = self.mongo.app.config['MONGODB_STORE_NS']
+
+        def transform_value(value):
+            if not store_ns:
+                # models know their collection without an `_ns`
+                name = _model_collection(value)
+                if name is not None and value.get("_id", None) is not None:
+                    return DBRef(name, transform_value(value["_id"]),
+                                 self._ref_database(name, collection))
+            if isinstance(value, CompactDocument):
+                value = value.to_son()
+            if isinstance(value, dict):
+                if "_id" in value and "_ns" in value:
+                    return DBRef(value["_ns"], transform_value(value["_id"]),
+                                 self._ref_database(value["_ns"], collection))
+                return transform_dict(SON(value))
+            elif isinstance(value, list):
+                return [transform_value(v) for v in value]
+            return value
+
+        def transform_dict(object):
+            for (key, value) in object.items():
+                object[key] = transform_value(value)
+            return object
+
+        son = SON(son)
+        if not store_ns:
+            son.pop("_ns", None)
+        return transform_dict(son)
+
+    def _ref_database(self, name, collection):
+        """
+        The database to save in a reference to `name` from `collection`,
+        `None` when it is the same
+        """
+        model = self.mongo.mapper.get(name, None)
+        if model is None or collection is None:
+            return None
+        database = self.mongo.get_bind(model.__bind__)['DATABASE']
+        if database != collection.database.name:
+            return database
+
+    def transform_outgoing(self, son, collection):
+        if not self.mongo.instrumented:
+            return self._transform_outgoing(son, collection)
+        start = time.time()
+        try:
+            return self._transform_outgoing(son, collection)
+        finally:
+            self.mongo.add_timing('transform', time.time() - start)
+
+    def _transform_outgoing(self, son, collection):
+        if isinstance(son, _Resolved):
+            tree = son.tree
+            if tree is None:
+                tree = self.reference_tree(son, getattr(collection, 'name',
+                                                        None))
+        else:
+            if isinstance(collection, BaseQuery):
+                depth = collection.autoref_depth
+                fields = collection.autoref_fields
+            else:
+                depth = self.mongo.app.config['MONGODB_AUTOREF_DEPTH']
+                fields = None
+            tree = self.prefetch([son], getattr(collection, 'name', None),
+                                 depth, fields,
+                                 getattr(collection, 'database', None))[0]
+        if not tree:
+            # nothing to resolve nor to map
+            return son
+
+        def transform_value(value, tree):
+            if isinstance(value, (AttrDict, CompactDocument)):
+                # resolved by :meth:`prefetch` already
+                return value
+            elif isinstance(value, list):
+                return [transform_value(v, tree) for v in value]
+            elif isinstance(value, dict):
+                if value.get('_ns', None):
+                    # if the collection has a :class:`Model` mapper
+                    cls = self.mongo.mapper.get(value['_ns'], None)
+                    if cls:
+                        return transform_model(cls, value, tree)
+                return transform_dict(SON(value), tree)
+            return value
+
+        def transform_model(model, value, tree):
+            cls = model.schema_class() or model
+            # share one instance per document during a request
+            identity_map = self.mongo.identity_map
+            if identity_map is None or value.get('_id', None) is None:
+                return _load(cls, transform_dict(SON(value), tree))
+            key = (self.mongo.get_session(model.__bind__).name,
+                   value['_ns'], value['_id'])
+            if key not in identity_map:
+                identity_map[key] = _load(cls,
+                                          transform_dict(SON(value), tree))
+            return identity_map[key]
+
+        def transform_dict(object, tree):
+            # only the paths of `tree`, everything else stays as it is
+            for key, subtree in tree.iteritems():
+                if key in object:
+                    object[key] = transform_value(object[key], subtree)
+            return object
+
+        return transform_dict(son, tree)
+
+
+class MongoJSONEncoder(json.JSONEncoder):
+    """
+    JSON encoder for models and documents: `ObjectId` as its hex string,
+    `DBRef` as `{"$ref": collection, "$id": id}`, dates and datetimes in ISO
+    8601 and :class:`CompactDocument` as a dict. :class:`AttrDict` and
+    :class:`Model` are dicts and need nothing special.
+    """
+    def default(self, o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, DBRef):
+            return {'$ref': o.collection, '$id': o.id}
+        if isinstance(o, (datetime, date)):
+            return o.isoformat()
+        if isinstance(o, CompactDocument):
+            return o.to_son()
+        return json.JSONEncoder.default(self, o)
+
+
+def dumps(obj, **kwargs):
+    """
+    Serialize `obj` to JSON with :class:`MongoJSONEncoder`
+    """
+    return json.dumps(obj, cls=MongoJSONEncoder, **kwargs)
+
+
+def stream_json(documents, batch_size=100, **kwargs):
+    """
+    A response sending `documents`, a cursor or any iterable, as a JSON
+    array, one batch of `batch_size` documents at a time, so that the first
+    bytes go out right away and memory use doesn't grow with the number of
+    documents. Documents of a :class:`MongoCursor` are encoded as they come
+    from the database, without building models. `kwargs` go to the
+    response.
+    """
+    if isinstance(documents, MongoCursor):
+        documents = documents.batch_size(batch_size).iter_raw()
+    encode = MongoJSONEncoder().encode
+
+    def generate():
+        yield '['
+        batch = []
+        separator = ''
+        for document in documents:
+            batch.append(encode(document))
+            if len(batch) >= batch_size:
+                yield separator + ','.join(batch)
+                separator = ','
+                batch = []
+        if batch:
+            yield separator + ','.join(batch)
+        yield ']'
+
+    kwargs.setdefault('mimetype', 'application/json')
+    return Response(generate(), **kwargs)
+
+
+def _model_collection(value):
+    """
+    The collection of `value` if it is a model instance, else `None`
+    """
+    if isinstance(value, Model):
+        return value.__collection__
+    if isinstance(value, CompactModel):
+        return value.model.__collection__
+    return None
+
+
+def _copy_injected(son, document):
+    """
+    Copy the fields the incoming manipulators added to `son` back to the
+    :class:`CompactDocument` it was built from
+    """
+    for key in ("_id", "_ns"):
+        if key in son and son[key] != document.get(key):
+            document[key] = son[key]
+
+
+def _spec_id(spec_or_id):
+    """
+    Return the `_id` a :meth:`BaseQuery.find_one` spec is looking for, or
+    `None` if the spec is not a plain lookup by id.
+    """
+    if spec_or_id is None:
+        return None
+    if not isinstance(spec_or_id, dict):
+        return spec_or_id
+    if spec_or_id.keys() == ['_id'] and not isinstance(spec_or_id['_id'], dict):
+        return spec_or_id['_id']
+    return None
+
+
+def _sort_values(item, sort):
+    """
+    The values of the `sort` keys, dotted or not, in `item`
+    """
+    values = []
+    for key, direction in sort:
+        value = item
+        for part in key.split('.'):
+            try:
+                value = value[part]
+            except (KeyError, TypeError):
+                value = None
+                break
+        values.append(value)
+    return values
+
+
+def _encode_cursor(values):
+    return urlsafe_b64encode(BSON.encode({'v': values}))
+
+
+def _decode_cursor(token):
+    try:
+        return BSON(urlsafe_b64decode(str(token))).decode()['v']
+    except Exception:
+        raise ValueError('invalid page cursor %r' % (token,))
+
+
+def _keyset_spec(spec, sort, values, forward=True):
+    """
+    Add to `spec` the condition for the documents that come after `values`
+    in the `sort` order, or before them if not `forward`
+    """
+    clauses = []
+    for i, (key, direction) in enumerate(sort):
+        clause = dict((k, v) for (k, d), v in zip(sort[:i], values))
+        after = (direction == 1) == forward
+        clause[key] = {after and '$gt' or '$lt': values[i]}
+        clauses.append(clause)
+    if len(clauses) == 1:
+        condition = clauses[0]
+    else:
+        condition = {'$or': clauses}
+    if not spec:
+        return condition
+    if not set(condition) & set(spec):
+        return dict(spec, **condition)
+    return {'$and': [spec, condition]}
+
+
+class Page(object):
+    """
+    A page of models from :meth:`BaseQuery.page`. :attr:`next_cursor` and
+    :attr:`prev_cursor` are opaque strings to pass as `after` and `before`
+    to get the next and the previous page, `None` when there is no such page.
+    """
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Pagination(object):
+    """
+    A numbered page of models from :meth:`BaseQuery.paginate`. :attr:`total`
+    is an estimate, see :meth:`BaseQuery.paginate`.
+    """
+    def __init__(self, items, page, per_page, total):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+
+    @property
+    def pages(self):
+        return (self.total + self.per_page - 1) // self.per_page
+
+    @property
+    def has_prev(self):
+        return self.page > 1
 
-class MongoCursor(Cursor):
-    """
-    A cursor that will return an instance of :attr:`as_class` instead of
-    `dict`
-    """
-    def __init__(self, *args, **kwargs):
-        self.as_class = kwargs.pop('as_class')
-        super(MongoCursor, self).__init__(*args, **kwargs)
+    @property
+    def prev_num(self):
+        return self.page - 1
 
-    def next(self):
-        data = super(MongoCursor, self).next()
-        return self.as_class(data)
+    @property
+    def has_next(self):
+        return self.page < self.pages
 
-    def __getitem__(self, index):
-        item = super(MongoCursor, self).__getitem__(index)
-        if isinstance(index, slice):
-            return item
-        else:
-            return self.as_class(item)
+    @property
+    def next_num(self):
+        return self.page + 1
 
+    def __iter__(self):
+        return iter(self.items)
 
-class AutoReferenceObject(AutoReference):
+
+class AggregateCursor(object):
     """
-    Transparently reference and de-reference already saved embedded objects.
+    Iterate over the results of an aggregation pipeline, see
+    :meth:`BaseQuery.aggregate`. The pipeline runs when the cursor is first
+    iterated, and the results are then fetched from the server one batch
+    at a time instead of all at once.
 
-    This manipulator should probably only be used when the NamespaceInjector is
-    also being used, otherwise it doesn't make too much sense - documents can
-    only be auto-referenced if they have an `_ns` field.
+    Results are instances of `as_class` if given. Otherwise those that still
+    carry the `_ns` of a mapped collection are instances of its model, and
+    the others :class:`AttrDict`. The references they hold are resolved
+    like those of a :class:`MongoCursor`, a batch at a time.
+    """
+    def __init__(self, query, pipeline, as_class=None, batch_size=None,
+                 allow_disk_use=False, manipulate=True):
+        self.query = query
+        self.pipeline = list(pipeline)
+        self.as_class = as_class
+        self.batch_size = batch_size
+        self.allow_disk_use = allow_disk_use
+        self.manipulate = manipulate
+        self._data = []
+        self._id = None
+        self._namespace = None
+        self._started = False
 
-    If the document should be an instance of a :class:`flaskext.mongoobject.Model`
-    then we will transform it into a model's instance too.
+    def _command(self, **options):
+        command = SON([('aggregate', self.query.name),
+                       ('pipeline', self.pipeline)])
+        command.update(options)
+        database = self.query.database
+        # without the manipulators of the database, references are only
+        # resolved once, by _refresh
+        result = database['$cmd'].find_one(command, _must_use_master=True,
+                                           _is_command=True, manipulate=False)
+        helpers._check_command_response(result, database.connection.disconnect,
+                                        "command %r failed: %%s" % command)
+        return result
 
-    NOTE: this will behave poorly if you have a circular reference.
+    def _send(self):
+        cursor = {}
+        if self.batch_size:
+            cursor['batchSize'] = self.batch_size
+        options = {}
+        if self.allow_disk_use:
+            options['allowDiskUse'] = True
+        spec = {'pipeline': self.pipeline}
+        try:
+            result = self.query._timed('aggregate', spec, None, self._command,
+                                       cursor=cursor, **options)
+        except OperationFailure as excn:
+            if 'unrecognized field' not in str(excn):
+                raise
+            # servers before 2.6 know neither option and send all the
+            # results at once
+            result = self.query._timed('aggregate', spec, None, self._command)
+        if 'cursor' in result:
+            self._id = result['cursor']['id']
+            self._namespace = result['cursor']['ns']
+            return result['cursor']['firstBatch']
+        return result['result']
 
-    TODO: this only works for documents that are in the same database. To fix
-    this we'll need to add a DatabaseInjector that adds `_db` and then make
-    use of the optional `database` support for DBRefs.
-    """
+    def _get_more(self):
+        connection = self.query.database.connection
+        message = get_more(self._namespace, self.batch_size or 0, self._id)
+        start = time.time()
+        # aggregations run on the master, their cursors live there
+        response = connection._send_message_with_response(
+            message, _must_use_master=True)
+        if isinstance(connection, MasterSlaveConnection):
+            response = response[1]
+        response = helpers._unpack_response(response, self._id)
+        self._id = response['cursor_id']
+        mongo = self.query.mongo
+        if mongo is not None and mongo.instrumented:
+            mongo.record(self.query.name, 'getmore',
+                         {'pipeline': self.pipeline}, time.time() - start,
+                         response['number_returned'])
+        return response['data']
 
-    def __init__(self, mongo):
-        self.mongo = mongo
-        self.db = mongo.session
+    def _refresh(self):
+        if not self._started:
+            self._started = True
+            batch = self._send()
+        elif self._id:
+            batch = self._get_more()
+        else:
+            return 0
+        mongo = self.query.mongo
+        resolver = mongo is not None and self.manipulate and mongo.autoref
+        if batch and resolver:
+            trees = resolver.prefetch(batch, self.query.name,
+                                      self.query.autoref_depth,
+                                      self.query.autoref_fields,
+                                      self.query.database)
+            batch = [_Resolved(document, tree)
+                     for document, tree in zip(batch, trees)]
+        self._data = batch
+        return len(batch)
 
-    def transform_outgoing(self, son, collection):
-        def transform_value(value):
-            if isinstance(value, DBRef):
-                return transform_value(self.__database.dereference(value))
-            elif isinstance(value, list):
-                return [transform_value(v) for v in value]
-            elif isinstance(value, dict):
-                if value.get('_ns', None):
-                    # if the collection has a :class:`Model` mapper
-                    cls = self.mongo.mapper.get(value['_ns'], None)
-                    if cls:
-                        return cls(transform_dict(SON(value)))
-                return transform_dict(SON(value))
-            return value
+    def _load(self, document):
+        if self.manipulate:
+            document = self.query.database._fix_outgoing(document, self.query)
+        cls = self.as_class
+        if cls is None:
+            mongo = self.query.mongo
+            model = mongo is not None and \
+                mongo.mapper.get(document.get('_ns', None), None)
+            cls = model and (model.schema_class() or model) or AttrDict
+        return _load(cls, document)
 
-        def transform_dict(object):
-            for (key, value) in object.items():
-                object[key] = transform_value(value)
-            return object
+    def __iter__(self):
+        return self
 
-        value = transform_dict(SON(son))
-        return value
+    def next(self):
+        if not self._data and not self._refresh():
+            raise StopIteration
+        return self._load(self._data.pop(0))
+
+    def close(self):
+        """
+        Kill the cursor on the server, when the results were not all read
+        """
+        if self._id:
+            connection = self.query.database.connection
+            if isinstance(connection, MasterSlaveConnection):
+                connection.close_cursor(self._id, -1)
+            else:
+                connection.close_cursor(self._id)
+        self._id = None
+        self._data = []
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
 
 
 class BaseQuery(Collection):
     """
     `BaseQuery` extends :class:`pymongo.Collection` that replaces all results
     coming from database with instance of :class:`Model`
+
+    When the identity map is enabled, :meth:`find_one`, :meth:`get_or_404`
+    and :meth:`get_many` return the instance already loaded for an `_id`
+    during the current request instead of querying again.
     """
 
+    #: most ids sent in one `$in` query by :meth:`get_many`, which keeps
+    #: the queries well under the maximum size of a BSON document
+    get_many_chunk_size = 1000
+
     def __init__(self, *args, **kwargs):
-        self.document_class = kwargs.pop('document_class')
+        document_class = kwargs.pop('document_class')
+        schema_class = getattr(document_class, 'schema_class', None)
+        self.document_class = schema_class and schema_class() or document_class
+        self.mongo = kwargs.pop('mongo', None)
+        cache = getattr(document_class, '__cache__', False)
+        #: seconds query results of this collection stay in the query cache
+        self.cache_timeout = None
+        #: levels of references resolved by default, see
+        #: :meth:`AutoReferenceObject.prefetch`
+        self.autoref_depth = getattr(document_class, '__autoref_depth__',
+                                     None)
+        if self.autoref_depth is None and self.mongo is not None:
+            self.autoref_depth = \
+                self.mongo.app.config['MONGODB_AUTOREF_DEPTH']
+        #: fields loaded per reference path by default
+        self.autoref_fields = getattr(document_class, '__autoref_fields__',
+                                      None)
+        if cache is not True and cache is not False:
+            self.cache_timeout = cache
+        self.use_cache = cache is not False
+        #: keep the counts of :meth:`cached_count` in the query cache
+        self.cache_counts = self.use_cache or \
+            getattr(document_class, '__cache_counts__', False)
         super(BaseQuery, self).__init__(*args, **kwargs)
 
-    def find_one(self, *args, **kwargs):
+    @property
+    def cache(self):
+        if self.use_cache and self.mongo is not None:
+            return self.mongo.query_cache
+
+    def invalidate_cache(self):
+        """
+        Forget the cached query results and counts of this collection, if
+        its model caches either of them
+        """
+        cache = self.mongo is not None and self.mongo.query_cache or None
+        if cache is not None and self.cache_counts:
+            cache.invalidate(self.name)
+
+    @property
+    def identity_map(self):
+        if self.mongo is not None:
+            return self.mongo.identity_map
+
+    @property
+    def unit_of_work(self):
+        if self.mongo is not None:
+            unit = self.mongo.unit_of_work
+            if unit is not None and not unit.flushing:
+                return unit
+
+    def find_one(self, spec_or_id=None, *args, **kwargs):
         kwargs['as_class'] = self.document_class
-        return super(BaseQuery, self).find_one(*args, **kwargs)
+        identity_map = self.identity_map
+        # partial documents never go into the identity map
+        if identity_map is None or args or kwargs.get('fields') is not None:
+            return super(BaseQuery, self).find_one(spec_or_id, *args, **kwargs)
+
+        id = _spec_id(spec_or_id)
+        key = (self.database.name, self.name, id)
+        if id is not None and key in identity_map:
+            return identity_map[key]
+        item = super(BaseQuery, self).find_one(spec_or_id, *args, **kwargs)
+        if item is not None and item.get('_id', None) is not None:
+            item = identity_map.setdefault(
+                (self.database.name, self.name, item['_id']), item)
+        return item
 
     def find(self, *args, **kwargs):
+        """
+        Like :meth:`pymongo.collection.Collection.find`, plus
+        `autoref_depth` and `autoref_fields` to override how references are
+        resolved, see :meth:`AutoReferenceObject.prefetch`
+        """
         kwargs['as_class'] = self.document_class
+        kwargs.setdefault('autoref_depth', self.autoref_depth)
+        kwargs.setdefault('autoref_fields', self.autoref_fields)
+        if self.mongo is not None:
+            kwargs.setdefault('slave_okay',
+                              self.mongo.app.config['MONGODB_SLAVE_OKAY'])
         return MongoCursor(self, *args, **kwargs)
 
+    def _timed(self, operation, spec, documents, method, *args, **kwargs):
+        """
+        Call `method`, recording it as `operation` if the operations are
+        instrumented
+        """
+        mongo = self.mongo
+        if mongo is None or not mongo.instrumented:
+            return method(*args, **kwargs)
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            mongo.record(self.name, operation, spec, time.time() - start,
+                         documents)
+
     def find_and_modify(self, *args, **kwargs):
         kwargs['as_class'] = self.document_class
-        return super(BaseQuery, self).find_and_modify(*args, **kwargs)
+        spec = args and args[0] or kwargs.get('query')
+        item = None
+        try:
+            item = self._timed('find_and_modify', spec, 1,
+                               super(BaseQuery, self).find_and_modify,
+                               *args, **kwargs)
+            return item
+        finally:
+            self.invalidate_cache()
+            if kwargs.get('remove'):
+                if item is not None and item.get('_id', None) is not None:
+                    self._evict({'_id': item['_id']})
+                else:
+                    # failed, any document the spec matches may be gone
+                    self._evict(spec or {})
+
+    def prepare_changes(self, changes):
+        """
+        Turn embedded documents of `$set`/`$unset` operators into references,
+        the same way saving a whole document would.
+        """
+        if self.mongo is not None and self.mongo.autoref is not None:
+            return self.mongo.autoref.transform_incoming(changes, self)
+        return changes
+
+    def save(self, to_save, *args, **kwargs):
+        # saving goes through :meth:`insert` or :meth:`update`
+        if not isinstance(to_save, CompactDocument):
+            return super(BaseQuery, self).save(to_save, *args, **kwargs)
+        son = to_save.to_son()
+        result = super(BaseQuery, self).save(son, *args, **kwargs)
+        _copy_injected(son, to_save)
+        return result
+
+    def insert(self, doc_or_docs, *args, **kwargs):
+        documents = isinstance(doc_or_docs, list) and len(doc_or_docs) or 1
+        try:
+            return self._timed('insert', None, documents, self._insert,
+                               doc_or_docs, *args, **kwargs)
+        finally:
+            self.invalidate_cache()
+
+    def _insert(self, doc_or_docs, *args, **kwargs):
+        if isinstance(doc_or_docs, CompactDocument):
+            son = doc_or_docs.to_son()
+            result = super(BaseQuery, self).insert(son, *args, **kwargs)
+            _copy_injected(son, doc_or_docs)
+            return result
+        if isinstance(doc_or_docs, list) and \
+                any(isinstance(d, CompactDocument) for d in doc_or_docs):
+            sons = [isinstance(d, CompactDocument) and d.to_son() or d
+                    for d in doc_or_docs]
+            result = super(BaseQuery, self).insert(sons, *args, **kwargs)
+            for son, document in zip(sons, doc_or_docs):
+                _copy_injected(son, document)
+            return result
+        return super(BaseQuery, self).insert(doc_or_docs, *args, **kwargs)
+
+    def update(self, spec, document, *args, **kwargs):
+        if isinstance(document, CompactDocument):
+            document = document.to_son()
+        try:
+            return self._timed('update', spec, None,
+                               super(BaseQuery, self).update,
+                               spec, document, *args, **kwargs)
+        finally:
+            self.invalidate_cache()
+
+    def remove(self, spec_or_id=None, *args, **kwargs):
+        try:
+            return self._timed('remove', spec_or_id, None,
+                               super(BaseQuery, self).remove,
+                               spec_or_id, *args, **kwargs)
+        finally:
+            self.invalidate_cache()
+            self._evict(spec_or_id)
+
+    def _evict(self, spec_or_id):
+        """
+        Forget the removed documents in the identity map: the one with the
+        `_id` or the `_id`s in `$in` of `spec_or_id`, or else all of those
+        of the collection
+        """
+        identity_map = self.identity_map
+        if not identity_map:
+            return
+        id = _spec_id(spec_or_id)
+        if id is not None:
+            ids = [id]
+        elif isinstance(spec_or_id, dict) and spec_or_id.keys() == ['_id'] \
+                and spec_or_id['_id'].keys() == ['$in']:
+            ids = spec_or_id['_id']['$in']
+        else:
+            ids = [key[2] for key in identity_map
+                   if key[:2] == (self.database.name, self.name)]
+        for id in ids:
+            identity_map.pop((self.database.name, self.name, id), None)
 
     def get_or_404(self, id):
         item = self.find_one(id, as_class=self.document_class)
@@ -176,33 +2013,344 @@ class BaseQuery(Collection):
             abort(404)
         return item
 
+    def get_many(self, ids, fields=None):
+        """
+        The models of `ids`, in the order of `ids`, fetched with one `$in`
+        query per :attr:`get_many_chunk_size` ids. An id without document
+        gives `None` at its position.
+        """
+        ids = list(ids)
+        found = {}
+        # partial documents never go into the identity map
+        identity_map = self.identity_map if fields is None else None
+        if identity_map is not None:
+            for id in ids:
+                key = (self.database.name, self.name, id)
+                if key in identity_map:
+                    found[id] = identity_map[key]
+
+        wanted = []
+        for id in ids:
+            if id not in found:
+                found[id] = None
+                wanted.append(id)
+        size = self.get_many_chunk_size
+        for start in xrange(0, len(wanted), size):
+            spec = {'_id': {'$in': wanted[start:start + size]}}
+            for item in self.find(spec, fields):
+                if identity_map is not None:
+                    item = identity_map.setdefault(
+                        (self.database.name, self.name, item['_id']), item)
+                found[item['_id']] = item
+        return [found[id] for id in ids]
+
+    def get_many_or_404(self, ids, fields=None):
+        """
+        Like :meth:`get_many`, but abort with a 404 if any id has no
+        document
+        """
+        items = self.get_many(ids, fields)
+        if None in items:
+            abort(404)
+        return items
+
+    def page(self, spec=None, sort=None, per_page=20, after=None,
+             before=None, fields=None):
+        """
+        Return a :class:`Page` of `per_page` models matching `spec`, the
+        first one or the one right after or before the cursor of another
+        page. Pages are found with a range on the `sort` keys instead of
+        skipping documents, so the deepest pages are as fast as the first
+        one as long as the keys are indexed. `sort` is a list of
+        `(key, direction)` and defaults to `_id`, which is always added as
+        the last key so that the order is total.
+        """
+        sort = list(sort or [])
+        if '_id' not in [key for key, direction in sort]:
+            sort.append(('_id', 1))
+        if fields is not None:
+            fields = list(fields) + [key for key, direction in sort]
+
+        forward = before is None
+        if after is not None or before is not None:
+            values = _decode_cursor(forward and after or before)
+            spec = _keyset_spec(spec, sort, values, forward)
+        order = forward and sort or [(k, -d) for k, d in sort]
+        items = list(self.find(spec, fields).sort(order).limit(per_page + 1))
+        more = len(items) > per_page
+        items = items[:per_page]
+        if not forward:
+            items.reverse()
+        if not items:
+            return Page(items)
+
+        first = _encode_cursor(_sort_values(items[0], sort))
+        last = _encode_cursor(_sort_values(items[-1], sort))
+        if forward:
+            return Page(items, more and last or None,
+                        after is not None and first or None)
+        return Page(items, last, more and first or None)
+
+    def paginate(self, page, per_page=20, spec=None, sort=None,
+                 error_out=True):
+        """
+        Return the :class:`Pagination` of the models matching `spec` for the
+        page number `page`, counting from 1. Pages are found by skipping
+        documents, use :meth:`page` for deep pages. The total comes
+        from :meth:`cached_count`, so it is only an estimate. With
+        `error_out`, abort with a 404 if `page` is out of range.
+        """
+        if page < 1:
+            if error_out:
+                abort(404)
+            page = 1
+        cursor = self.find(spec)
+        if sort:
+            cursor = cursor.sort(sort)
+        items = list(cursor.skip((page - 1) * per_page).limit(per_page))
+        if not items and page != 1 and error_out:
+            abort(404)
+        return Pagination(items, page, per_page, self.cached_count(spec))
+
+    def aggregate(self, pipeline, as_class=None, batch_size=None,
+                  allow_disk_use=False):
+        """
+        Run the aggregation `pipeline`, a list of stages, on the collection
+        and return an :class:`AggregateCursor` over its results::
+
+            for row in Post.query.aggregate([
+                    {"$match": {"published": True}},
+                    {"$group": {"_id": "$author", "posts": {"$sum": 1}}}]):
+                print row._id, row.posts
+
+        `batch_size` is how many results each round trip brings back,
+        `allow_disk_use` lets the stages that need it write temporary files
+        on the server instead of failing past their memory limit. Results
+        are instances of `as_class`, or of the model mapped to their `_ns`
+        by default.
+        """
+        return AggregateCursor(self, pipeline, as_class, batch_size,
+                               allow_disk_use)
+
+    def estimated_count(self):
+        """
+        The number of documents of the collection, read from its statistics
+        instead of counted, which may be off after an unclean shutdown or
+        while chunks migrate
+        """
+        return self.database.command('collstats', self.name)['count']
+
+    def cached_count(self, spec=None, timeout=None):
+        """
+        The number of documents matching `spec`, or :meth:`estimated_count`
+        without `spec`. When the model declares `__cache_counts__` or
+        `__cache__`, it is kept in the query cache for `timeout` seconds,
+        ``MONGODB_COUNT_CACHE_TIMEOUT`` by default, or until the collection
+        is written to through its model.
+        """
+        cache = self.cache_counts and self.mongo is not None and \
+            self.mongo.query_cache or None
+        if cache is not None:
+            key = cache.key(self.name, ('count', spec))
+            count = cache.backend.get(key)
+            if count is not None:
+                return count
+        if spec:
+            count = self.find(spec).count()
+        else:
+            count = self.estimated_count()
+        if cache is not None:
+            if timeout is None:
+                timeout = self.mongo.app.config['MONGODB_COUNT_CACHE_TIMEOUT']
+            cache.backend.set(key, count, timeout)
+        return count
+
+
+class AsyncCursor(object):
+    """
+    Iterate over a :class:`MongoCursor` from the thread pool of
+    :class:`MongoObject`. Documents are fetched `batch_size` at a time and
+    the next batch is already being fetched while the current one is
+    consumed.
+    """
+    def __init__(self, cursor, mongo, batch_size=100):
+        self.cursor = cursor
+        self.mongo = mongo
+        self.batch_size = batch_size
+
+    def _next_batch(self):
+        batch = []
+        for item in self.cursor:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                break
+        return batch
+
+    def fetch(self):
+        """
+        Return an `AsyncResult` of the list of the next documents, the list
+        is empty once the cursor is exhausted.
+        """
+        return self.mongo.run_async(self._next_batch)
+
+    def __iter__(self):
+        pending = self.fetch()
+        while pending is not None:
+            batch = pending.get()
+            if len(batch) < self.batch_size:
+                pending = None
+            else:
+                pending = self.fetch()
+            for item in batch:
+                yield item
+
+
+class AsyncBaseQuery(object):
+    """
+    Non-blocking counterpart of :class:`BaseQuery`, available as
+    :attr:`Model.aquery`. Each method runs the matching blocking call on the
+    thread pool of :class:`MongoObject` and returns a
+    :class:`multiprocessing.pool.AsyncResult` right away, call `get()` on it
+    to wait for the same result the blocking call would return::
+
+        pending = Post.aquery.find_one({"title": "test"})
+        # ... do something else
+        post = pending.get()
+
+    The calls run outside of the request, so they don't use the identity map
+    or the unit of work.
+    """
+    def __init__(self, query):
+        self.query = query
+        self.mongo = query.mongo
+
+    def find_one(self, *args, **kwargs):
+        return self.mongo.run_async(self.query.find_one, *args, **kwargs)
+
+    def get_or_404(self, id):
+        return self.mongo.run_async(self.query.get_or_404, id)
+
+    def find(self, *args, **kwargs):
+        """
+        Return an :class:`AsyncCursor`, the query is only sent when it is
+        first iterated or fetched
+        """
+        batch_size = kwargs.pop('batch_size', 100)
+        return AsyncCursor(self.query.find(*args, **kwargs), self.mongo,
+                           batch_size)
+
+    def save(self, model, *args, **kwargs):
+        return self.mongo.run_async(model.save, *args, **kwargs)
+
+    def update(self, model, *args, **kwargs):
+        return self.mongo.run_async(model.update, *args, **kwargs)
+
+    def remove(self, model):
+        return self.mongo.run_async(model.remove)
+
+
+class _AsyncQueryProperty(object):
+    """
+    Represent :attr:`Model.aquery`, an :attr:`Model.async_query_class`
+    wrapping :attr:`Model.query`
+    """
+    def __get__(self, instance, owner):
+        return owner.async_query_class(owner.query)
+
 
 class _QueryProperty(object):
     """
     Represent :attr:`Model.query` that dynamically instantiate
     :attr:`Model.query_class` so that we can do things like
     `Model.query.find_one`
+
+    The query of each model is built once and reused for as long as the
+    session of its :attr:`Model.__bind__` it was built for is current, see
+    :meth:`MongoObject.get_session`.
     """
     def __init__(self, mongo):
         self.mongo = mongo
+        self.queries = {}
 
     def __get__(self, instance, owner):
-        return owner.query_class(database=self.mongo.session,
-                                 name=owner.__collection__,
-                                 document_class=owner)
+        session = self.mongo.get_session(owner.__bind__)
+        query = self.queries.get(owner, None)
+        if query is None or query.database is not session:
+            query = owner.query_class(database=session,
+                                      name=owner.__collection__,
+                                      document_class=owner,
+                                      mongo=self.mongo)
+            self.queries[owner] = query
+        return query
 
 
 class Model(AttrDict):
     """
     Base class for custom user models. Provide convenience ActiveRecord
     methods such as :attr:`save`, :attr:`remove`
+
+    Models that were loaded from or already written to the database only send
+    the fields that changed since, see :meth:`AttrDict.get_changes`, and skip
+    the write altogether when nothing changed.
+
+    When the unit of work is enabled, :meth:`save`, :meth:`update` and
+    :meth:`remove` are queued and only sent when :meth:`MongoObject.flush`
+    runs, see :class:`UnitOfWork`.
+
+    Models loaded with a `fields` projection are partial: they can still
+    save the fields that changed, but refuse to replace the whole document,
+    and load the rest of the document the first time a missing field is
+    accessed.
+
+    With `background=True`, or :attr:`__write_behind__`, :meth:`save` and
+    :meth:`update` return right away and worker threads send the write
+    later, see :class:`WriteBehind`.
     """
     #: Query class
     query_class = BaseQuery
     #: instance of :attr:`query_class`
     query = None
+    #: Async query class
+    async_query_class = AsyncBaseQuery
+    #: instance of :attr:`async_query_class`
+    aquery = _AsyncQueryProperty()
     #: name of this model collection
     __collection__ = None
+    #: name of the entry of ``MONGODB_BINDS`` whose connection and database
+    #: hold the collection, `None` for ``MONGODB_HOST`` and
+    #: ``MONGODB_DATABASE``
+    __bind__ = None
+
+    #: optional schema, documents of models that declare one are loaded
+    #: as :class:`CompactModel` instances, see :func:`compile_schema`
+    __schema__ = None
+    #: cache query results, `True` or the number of seconds they are kept,
+    #: see :class:`QueryCache`
+    __cache__ = False
+    #: cache the counts of :meth:`BaseQuery.cached_count`, which writes to
+    #: the collection then invalidate, implied by :attr:`__cache__`
+    __cache_counts__ = False
+    #: levels of references resolved when loading the model, `None` for
+    #: ``MONGODB_AUTOREF_DEPTH``
+    __autoref_depth__ = None
+    #: only fields to load per reference path, such as
+    #: `{'author': ['name', 'avatar']}`
+    __autoref_fields__ = None
+    #: paths of the fields that can hold references or mapped documents,
+    #: such as `('author', 'comments.author')`, the only ones visited when
+    #: loading the model. `None` to look for them in every document.
+    __references__ = None
+    #: send :meth:`save` and :meth:`update` through
+    #: :attr:`MongoObject.write_behind` unless told otherwise
+    __write_behind__ = False
+    #: indexes of the collection, ensured in the background by
+    #: :class:`MongoObject`. Each one is a key, a list of `(key, direction)`
+    #: or a dict with the `key` and the options of the index such as
+    #: `unique`, `sparse` or `expire_after` (in seconds, for a TTL index)
+    __indexes__ = ()
+
+    # projection the model was loaded with, `None` for whole documents
+    __fields = None
 
     @property
     def id(self):
@@ -215,15 +2363,120 @@ class Model(AttrDict):
         assert '__collection__' not in kwargs
         super(Model, self).__init__(*args, **kwargs)
 
-    def save(self, *args, **kwargs):
-        self.query.save(self, *args, **kwargs)
+    @classmethod
+    def schema_class(cls):
+        """
+        Return the :class:`CompactModel` compiled from :attr:`__schema__`,
+        or `None` when the model doesn't declare a schema. The methods and
+        properties defined on the model are carried over to it.
+        """
+        if cls.__schema__ is None:
+            return None
+        if '_Model__compact' not in cls.__dict__:
+            schema = dict(cls.__schema__, _id=None, _ns=None)
+            attrs = {}
+            for klass in reversed(cls.__mro__[:cls.__mro__.index(Model)]):
+                for key, value in klass.__dict__.iteritems():
+                    if key.startswith('__') and key.endswith('__') or \
+                            key.startswith('_Model__') or key in schema or \
+                            hasattr(CompactModel, key):
+                        continue
+                    attrs[key] = value
+            cls.__compact = compile_schema(cls.__name__, schema, CompactModel,
+                                           model=cls, __module__=cls.__module__,
+                                           __doc__=cls.__doc__, **attrs)
+        return cls.__compact
+
+    @property
+    def is_partial(self):
+        return self.__fields is not None
+
+    def mark_partial(self, fields):
+        """
+        Record that only `fields` of the document were loaded
+        """
+        object.__setattr__(self, '_Model__fields', fields)
+
+    def load_fields(self):
+        """
+        Load the fields that were left out by the projection, keeping the
+        ones that were already loaded as they are
+        """
+        if not self.is_partial:
+            return
+        self.mark_partial(None)
+        document = self.query.find_one({"_id": self["_id"]})
+        if document is not None:
+            self._merge(document)
+
+    def __missing__(self, key):
+        # special names are looked up by all kinds of libraries, they are
+        # never worth a query
+        if self.is_partial and "_id" in self and \
+                not (isinstance(key, basestring) and key.startswith('__')):
+            self.load_fields()
+            return self[key]
+        raise KeyError(key)
+
+    def _check_replace(self):
+        if self.is_partial:
+            raise InvalidOperation("can't replace the whole document with a "
+                                   "partial %s" % self.__class__.__name__)
+
+    def _write_behind(self, background):
+        if background is None:
+            background = self.__write_behind__
+        mongo = getattr(self.query, 'mongo', None)
+        if background and mongo is not None:
+            return mongo.write_behind
+
+    def save(self, manipulate=True, safe=False, background=None, **kwargs):
+        writer = self._write_behind(background)
+        if writer is not None:
+            writer.save(self)
+            return self
+        unit = self.query.unit_of_work
+        if unit is not None:
+            unit.save(self, manipulate=manipulate, safe=safe, **kwargs)
+            return self
+        changes = self.get_changes()
+        if changes is None or "_id" not in self:
+            self._check_replace()
+            self.query.save(self, manipulate, safe, **kwargs)
+        elif changes:
+            self.query.update({"_id": self._id},
+                              self.query.prepare_changes(changes),
+                              True, False, safe, **kwargs)
+        self.mark_clean()
         return self
 
-    def update(self, *args, **kwargs):
-        self.query.update({"_id": self._id}, self, *args, **kwargs)
+    def update(self, upsert=False, manipulate=False, safe=False,
+               background=None, **kwargs):
+        writer = self._write_behind(background)
+        if writer is not None:
+            writer.update(self, upsert)
+            return self
+        unit = self.query.unit_of_work
+        if unit is not None:
+            unit.update(self, upsert=upsert, manipulate=manipulate, safe=safe,
+                        **kwargs)
+            return self
+        changes = self.get_changes()
+        if changes is None:
+            self._check_replace()
+            self.query.update({"_id": self._id}, self, upsert, manipulate,
+                              safe, **kwargs)
+        elif changes:
+            self.query.update({"_id": self._id},
+                              self.query.prepare_changes(changes),
+                              upsert, False, safe, **kwargs)
+        self.mark_clean()
         return self
 
     def remove(self):
+        unit = self.query.unit_of_work
+        if unit is not None:
+            return unit.remove(self)
         return self.query.remove(self._id)
 
     def __str__(self):
@@ -234,28 +2487,630 @@ class Model(AttrDict):
         return str(self).decode('utf-8')
 
 
+class CompactModel(CompactDocument):
+    """
+    What documents of a :class:`Model` declaring a :attr:`Model.__schema__`
+    are loaded as. It has the same :attr:`query`, :meth:`save`,
+    :meth:`update` and :meth:`remove`, but always writes the whole document
+    and doesn't support partial loading or the unit of work. It has the
+    methods of its model but is not an instance of it, check :attr:`model`
+    instead.
+    """
+    __slots__ = ()
+    #: :class:`Model` this class was compiled from
+    model = None
+
+    @property
+    def query(self):
+        return self.model.query
+
+    @property
+    def id(self):
+        if self.get("_id", None):
+            return str(self["_id"])
+
+    def save(self, *args, **kwargs):
+        self.query.save(self, *args, **kwargs)
+        return self
+
+    def update(self, *args, **kwargs):
+        self.query.update({"_id": self["_id"]}, self, *args, **kwargs)
+        return self
+
+    def remove(self):
+        return self.query.remove(self["_id"])
+
+
+class UnitOfWork(object):
+    """
+    Writes of :class:`Model` instances queued during a request. Nothing is
+    sent until :meth:`flush`, which then goes through the collections in the
+    order they were first written to and, for each of them, inserts all new
+    documents with a single batch insert, saves or updates the changed ones
+    once each, with all their changes merged, and removes the deleted ones
+    with a single `$in` query.
+
+    New documents get their `_id` as soon as they are saved, so they can be
+    referenced before being flushed.
+    """
+    def __init__(self):
+        self.flushing = False
+        self.reset()
+
+    def reset(self):
+        self.queries = []
+        self.new = {}
+        self.dirty = {}
+        self.removed = {}
+
+    def _pending(self, model):
+        name = model.query.name
+        if name not in self.new:
+            self.queries.append(model.query)
+            self.new[name] = []
+            self.dirty[name] = []
+            self.removed[name] = []
+        return self.new[name], self.dirty[name], self.removed[name]
+
+    def save(self, model, **kwargs):
+        new, dirty, removed = self._pending(model)
+        if "_id" not in model:
+            model._check_replace()
+            model["_id"] = ObjectId()
+            # documents flushed before it must reference it, not embed it
+            mongo = model.query.mongo
+            if mongo is not None and mongo.autoref is not None and \
+                    mongo.app.config['MONGODB_STORE_NS']:
+                model.setdefault("_ns", model.query.name)
+            new.append((model, kwargs))
+        else:
+            self._change(model, 'save', kwargs)
+
+    def update(self, model, **kwargs):
+        self._change(model, 'update', kwargs)
+
+    def _change(self, model, method, kwargs):
+        new, dirty, removed = self._pending(model)
+        # changes to a new document go out with its insert
+        if any(item is model for item, options in new):
+            return
+        for i, (item, queued, options) in enumerate(dirty):
+            if item is model:
+                safe = bool(options.get('safe') or kwargs.get('safe'))
+                if queued == 'save':
+                    # the save already writes whatever the update would
+                    method, kwargs = queued, options
+                dirty[i] = (model, method, dict(kwargs, safe=safe))
+                return
+        dirty.append((model, method, kwargs))
+
+    def remove(self, model):
+        new, dirty, removed = self._pending(model)
+        for items in (new, dirty):
+            items[:] = [entry for entry in items if entry[0] is not model]
+        removed.append(model._id)
+
+    def flush(self):
+        self.flushing = True
+        try:
+            for query in self.queries:
+                new = self.new[query.name]
+                if new:
+                    safe = any(options.get('safe') for _, options in new)
+                    query.insert([model for model, _ in new], safe=safe)
+                    for model, _ in new:
+                        model.mark_clean()
+                for model, method, kwargs in self.dirty[query.name]:
+                    getattr(model, method)(**kwargs)
+                removed = self.removed[query.name]
+                if removed:
+                    query.remove({"_id": {"$in": removed}})
+        finally:
+            self.flushing = False
+            self.reset()
+
+
+def _overlap(first, second):
+    return first == second or first.startswith(second + '.') or \
+        second.startswith(first + '.')
+
+
+def _merge_modifiers(first, second):
+    """
+    One update modifier doing what `first` then `second` do, or `None` if
+    they can't be merged: they use operators other than `$set`, `$unset`
+    and `$inc`, or the same fields through different operators
+    """
+    operators = ('$set', '$unset', '$inc')
+    if any(op not in operators for op in first) or \
+            any(op not in operators for op in second):
+        return None
+    merged = dict((op, dict(fields)) for op, fields in first.iteritems())
+    for op, fields in second.iteritems():
+        for key, value in fields.iteritems():
+            for other, other_fields in merged.iteritems():
+                for other_key in other_fields:
+                    if _overlap(key, other_key) and \
+                            (other != op or key != other_key):
+                        return None
+            target = merged.setdefault(op, {})
+            if op == '$inc' and key in target:
+                target[key] += value
+            else:
+                target[key] = value
+    return merged
+
+
+def _apply_modifier(document, modifier):
+    """
+    A copy of `document` with an update `modifier` applied, or `None` if
+    it uses operators other than `$set`, `$unset` and `$inc` or goes
+    through fields that are not embedded documents
+    """
+    if any(op not in ('$set', '$unset', '$inc') for op in modifier):
+        return None
+    document = _copy_tree(document)
+    for op, fields in modifier.iteritems():
+        for key, value in fields.iteritems():
+            parts = key.split('.')
+            target = document
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+                if not isinstance(target, dict):
+                    return None
+            if op == '$set':
+                target[parts[-1]] = value
+            elif op == '$unset':
+                target.pop(parts[-1], None)
+            else:
+                target[parts[-1]] = target.get(parts[-1], 0) + value
+    return document
+
+
+class WriteBehind(object):
+    """
+    Writes of :class:`Model` instances sent by worker threads instead of the
+    request that made them, for writes that don't need to be acknowledged
+    such as counters or timestamps.
+
+    Writes are queued per document, in order. A write to a document that is
+    still queued is merged with the previous one when possible: a save
+    replaces it, and updates only using `$set`, `$unset` and `$inc` are
+    applied to a queued document or combined with a queued update of
+    distinct fields. Workers take up to :attr:`batch_size`
+    documents at once, insert the new ones with one batch insert and send
+    identical updates of several documents as one `multi` update. Saving
+    blocks while :attr:`size` writes are waiting, and :meth:`close` sends
+    everything still queued, which happens when the process exits.
+    """
+    #: documents a worker takes from the queue at once
+    batch_size = 100
+
+    def __init__(self, mongo, workers=2, size=10000):
+        self.mongo = mongo
+        self.size = size
+        self.count = 0
+        self.closed = False
+        # (collection, _id) -> (query, [(kind, document, upsert)])
+        self.pending = OrderedDict()
+        self.busy = set()
+        self.lock = threading.Condition()
+        self.threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work,
+                                      name='mongoobject-write-behind-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def save(self, model):
+        """
+        Queue what :meth:`Model.save` would send. New documents get their
+        `_id` right away.
+        """
+        query = model.query
+        changes = model.get_changes()
+        if changes is None or "_id" not in model:
+            model._check_replace()
+            new = "_id" not in model
+            if new:
+                model["_id"] = ObjectId()
+            mongo = query.mongo
+            if mongo is not None and mongo.autoref is not None and \
+                    mongo.app.config['MONGODB_STORE_NS']:
+                model.setdefault("_ns", query.name)
+            # embedded models become references now, a copy loses their type
+            self.put(query, model["_id"], new and 'insert' or 'replace',
+                     _copy_tree(query.prepare_changes(model)), True)
+        elif changes:
+            self.put(query, model["_id"], 'update',
+                     _copy_tree(query.prepare_changes(changes)), True)
+        model.mark_clean()
+
+    def update(self, model, upsert=False):
+        """
+        Queue what :meth:`Model.update` would send
+        """
+        query = model.query
+        changes = model.get_changes()
+        if changes is None:
+            model._check_replace()
+            self.put(query, model["_id"], 'replace',
+                     _copy_tree(query.prepare_changes(model)), upsert)
+        elif changes:
+            self.put(query, model["_id"], 'update',
+                     _copy_tree(query.prepare_changes(changes)), upsert)
+        model.mark_clean()
+
+    def put(self, query, id, kind, document, upsert=False):
+        """
+        Queue a write of `kind` `'insert'`, `'replace'` or `'update'` for the
+        document `id` of `query`
+        """
+        key = (query.name, id)
+        with self.lock:
+            while self.count >= self.size and key not in self.pending and \
+                    not self.closed:
+                self.lock.wait()
+            if self.closed:
+                raise RuntimeError('the write-behind queue is closed')
+            query, writes = self.pending.setdefault(key, (query, []))
+            before = len(writes)
+            if kind != 'update':
+                if writes and writes[0][0] == 'insert':
+                    kind = 'insert'
+                writes[:] = [(kind, document, upsert)]
+            else:
+                merged = None
+                if writes and writes[-1][0] != 'update':
+                    merged = _apply_modifier(writes[-1][1], document)
+                elif writes and writes[-1][2] == upsert:
+                    merged = _merge_modifiers(writes[-1][1], document)
+                if merged is not None:
+                    writes[-1] = (writes[-1][0], merged, writes[-1][2])
+                else:
+                    writes.append((kind, document, upsert))
+            self.count += len(writes) - before
+            self.lock.notify_all()
+
+    def _take(self):
+        batch = []
+        for key in self.pending.keys():
+            if len(batch) >= self.batch_size:
+                break
+            # writes to one document are sent in order, by one worker
+            if key not in self.busy:
+                query, writes = self.pending.pop(key)
+                self.busy.add(key)
+                batch.append((key, query, writes))
+        return batch
+
+    def _work(self):
+        while True:
+            with self.lock:
+                batch = self._take()
+                while not batch:
+                    if self.closed:
+                        return
+                    self.lock.wait()
+                    batch = self._take()
+            try:
+                self._write(batch)
+            except Exception:
+                self.mongo.app.logger.exception('write-behind failed')
+            finally:
+                with self.lock:
+                    for key, query, writes in batch:
+                        self.busy.discard(key)
+                        self.count -= len(writes)
+                    self.lock.notify_all()
+                if self.mongo._connection is not None:
+                    self.mongo._connection.end_request()
+
+    def _write(self, batch):
+        """
+        Send the writes of `batch`, a list of `(key, query, writes)`, the
+        first write of every document, then the second one, and so on
+        """
+        for i in xrange(max(len(writes) for key, query, writes in batch)):
+            inserts = OrderedDict()
+            updates = OrderedDict()
+            for (name, id), query, writes in batch:
+                if i >= len(writes):
+                    continue
+                kind, document, upsert = writes[i]
+                if kind == 'insert':
+                    inserts.setdefault(name, (query, []))[1].append(document)
+                    continue
+                # identical updates without upsert go out as one
+                shape = (name, kind, upsert, kind != 'replace' and
+                         not upsert and repr(_normalize(document)) or id)
+                updates.setdefault(shape, (query, kind, document, upsert,
+                                           []))[4].append(id)
+            for query, documents in inserts.itervalues():
+                query.insert(documents)
+            for query, kind, document, upsert, ids in updates.itervalues():
+                if len(ids) > 1:
+                    query.update({"_id": {"$in": ids}}, document,
+                                 multi=True)
+                else:
+                    query.update({"_id": ids[0]}, document, upsert,
+                                 kind == 'replace')
+
+    def flush(self):
+        """
+        Wait until every queued write was sent
+        """
+        with self.lock:
+            while self.count and self.threads:
+                self.lock.wait()
+        if not self.threads:
+            # no worker to send them
+            while True:
+                with self.lock:
+                    batch = self._take()
+                if not batch:
+                    break
+                try:
+                    self._write(batch)
+                finally:
+                    with self.lock:
+                        for key, query, writes in batch:
+                            self.busy.discard(key)
+                            self.count -= len(writes)
+
+    def close(self):
+        """
+        Send what is still queued and stop the workers
+        """
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+#: guards replacing the :attr:`MongoObject.lock` of a forked process
+_fork_lock = threading.Lock()
+
+
 class MongoObject(object):
+    """
+    The connection is only opened the first time it is used, and opened again
+    when used from a forked process, so it is safe to create the application
+    before a pre-forking server such as gunicorn starts its workers.
+
+    Models can live in other databases, on other servers, than the default
+    one: ``MONGODB_BINDS`` names them and :attr:`Model.__bind__` picks one.
+    Each bind has its own connection and pool of sockets.
+
+    It is safe to use from many threads, or greenlets, at once:
+
+    - connections, databases and their SON manipulators, the thread pool
+      and the write behind queue are shared by the whole process. Each is
+      set up once, under :attr:`lock`, and only published once ready.
+    - the identity map, the unit of work and the recorded queries belong
+      to the current context, a `werkzeug.local.Local`, which is per
+      greenlet when greenlet is installed and per thread otherwise.
+    - pymongo reserves a socket per thread for the requests it sends, which
+      is given back to the pool of the connection at the end of every
+      request, failed ones included, and after every call run on
+      :attr:`pool`. With gevent, patch `threading` so that pymongo reserves
+      one per greenlet instead.
+    """
     def __init__(self, app=None):
+        self.Model = self.make_model()
+        self.mapper = {}
+        self.autoref = None
+        self.db = None
+        self._local = Local()
+        self._lock = threading.RLock()
+        self._lock_pid = os.getpid()
+        self._connection = None
+        self._binds = {}
+        self._sessions = {}
+        self._pool = None
+        self._write_behind = None
+        self._indexed = set()
+        #: shapes of queries already checked by ``MONGODB_EXPLAIN_AUDIT``
+        self.audited = set()
+        self.query_cache = None
         if app is not None:
             self.app = app
             self.init_app(app)
-        self.Model = self.make_model()
-        self.mapper = {}
 
     def init_app(self, app):
         app.config.setdefault('MONGODB_HOST', "mongodb://localhost:27017")
         app.config.setdefault('MONGODB_DATABASE', "")
         app.config.setdefault('MONGODB_AUTOREF', True)
+        app.config.setdefault('MONGODB_AUTOREF_DEPTH', None)
+        app.config.setdefault('MONGODB_STORE_NS', True)
+        app.config.setdefault('MONGODB_IDENTITY_MAP', False)
+        app.config.setdefault('MONGODB_UNIT_OF_WORK', False)
+        app.config.setdefault('MONGODB_MAX_POOL_SIZE', 10)
+        app.config.setdefault('MONGODB_SOCKET_TIMEOUT', None)
+        app.config.setdefault('MONGODB_SLAVES', [])
+        app.config.setdefault('MONGODB_BINDS', {})
+        app.config.setdefault('MONGODB_SLAVE_OKAY', False)
+        app.config.setdefault('MONGODB_ASYNC_WORKERS', 4)
+        app.config.setdefault('MONGODB_QUERY_CACHE', 'simple')
+        app.config.setdefault('MONGODB_QUERY_CACHE_SIZE', 1000)
+        app.config.setdefault('MONGODB_QUERY_CACHE_TIMEOUT', 60)
+        app.config.setdefault('MONGODB_COUNT_CACHE_TIMEOUT', 60)
+        app.config.setdefault('MONGODB_RECORD_QUERIES', False)
+        app.config.setdefault('MONGODB_SLOW_QUERY_THRESHOLD', None)
+        app.config.setdefault('MONGODB_STATS_HEADER', False)
+        app.config.setdefault('MONGODB_ENSURE_INDEXES', True)
+        app.config.setdefault('MONGODB_EXPLAIN_AUDIT', False)
+        app.config.setdefault('MONGODB_WRITE_BEHIND', False)
+        app.config.setdefault('MONGODB_WRITE_BEHIND_WORKERS', 2)
+        app.config.setdefault('MONGODB_WRITE_BEHIND_SIZE', 10000)
         # initialize connection and Model properties
         self.app = app
-        self.connect()
+        self.db = None
+        self._connection = None
+        self.query_cache = self.make_query_cache()
         self.app.after_request(self.close_connection)
+        # after_request is skipped when the request fails, teardown isn't
+        self.app.teardown_request(self.teardown)
+
+    def make_query_cache(self):
+        """
+        Build the :class:`QueryCache` used by models declaring `__cache__`.
+        ``MONGODB_QUERY_CACHE`` is either `'simple'` for an in-process
+        :class:`LRUCache`, any `werkzeug.contrib.cache` backend, or `None`
+        to disable caching.
+        """
+        config = self.app.config
+        backend = config['MONGODB_QUERY_CACHE']
+        if backend is None:
+            return None
+        if backend == 'simple':
+            backend = LRUCache(config['MONGODB_QUERY_CACHE_SIZE'],
+                               config['MONGODB_QUERY_CACHE_TIMEOUT'])
+        return QueryCache(backend)
+
+    @property
+    def lock(self):
+        """
+        Lock held while the shared state is set up, replaced in a forked
+        process since the child could inherit it held
+        """
+        if self._lock_pid != os.getpid():
+            with _fork_lock:
+                if self._lock_pid != os.getpid():
+                    self._lock = threading.RLock()
+                    self._lock_pid = os.getpid()
+        return self._lock
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            with self.lock:
+                if self._connection is None or self._pid != os.getpid():
+                    self.connect()
+                    self._indexed = set()
+                    self.schedule_indexes(self.mapper.values())
+        return self._connection
+
+    @connection.setter
+    def connection(self, connection):
+        self._connection = connection
+        self._pid = os.getpid()
 
     def connect(self):
-        self.connection = Connection(self.app.config['MONGODB_HOST'])
+        self.connection = self.open_connection()
 
     def init_connection(self):
-        self.connection = Connection(self.app.config['MONGODB_HOST'])
+        self.connect()
+
+    def get_bind(self, bind=None):
+        """
+        The `HOST`, `DATABASE` and `SLAVES` of `bind`, an entry of
+        ``MONGODB_BINDS``. Those it leaves out are the ones of the default
+        bind, `None`, which are ``MONGODB_HOST``, ``MONGODB_DATABASE`` and
+        ``MONGODB_SLAVES``.
+        """
+        config = self.app.config
+        settings = {'HOST': config['MONGODB_HOST'],
+                    'DATABASE': config['MONGODB_DATABASE'],
+                    'SLAVES': config['MONGODB_SLAVES']}
+        if bind is not None:
+            try:
+                settings.update(config['MONGODB_BINDS'][bind])
+            except KeyError:
+                raise ValueError('no %r bind in MONGODB_BINDS' % bind)
+        return settings
+
+    def open_connection(self, bind=None):
+        """
+        Open a new connection to the servers of `bind`
+        """
+        config = self.app.config
+        settings = self.get_bind(bind)
+        options = dict(max_pool_size=config['MONGODB_MAX_POOL_SIZE'],
+                       network_timeout=config['MONGODB_SOCKET_TIMEOUT'])
+        master = Connection(settings['HOST'], **options)
+        if settings['SLAVES']:
+            # queries with `slave_okay` are sent to one of the slaves
+            slaves = [Connection(host, slave_okay=True, **options)
+                      for host in settings['SLAVES']]
+            return MasterSlaveConnection(master, slaves)
+        return master
+
+    def get_connection(self, bind=None):
+        """
+        The connection of `bind`, :attr:`connection` for the default one,
+        opened on first use in each process
+        """
+        if bind is None:
+            return self.connection
+        if self._binds.get(bind, (None, None))[1] != os.getpid():
+            with self.lock:
+                if self._binds.get(bind, (None, None))[1] != os.getpid():
+                    self._binds[bind] = (self.open_connection(bind),
+                                         os.getpid())
+        return self._binds[bind][0]
+
+    def _open_connections(self):
+        """
+        The connections already opened in this process
+        """
+        connections = [connection for connection, pid
+                       in self._binds.values() if pid == os.getpid()]
+        if self._connection is not None:
+            connections.append(self._connection)
+        return connections
+
+    @property
+    def pool(self):
+        """
+        Thread pool running the calls of :class:`AsyncBaseQuery`, created on
+        first use in each process
+        """
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self.lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    self._pool = ThreadPool(
+                        self.app.config['MONGODB_ASYNC_WORKERS'])
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    @property
+    def write_behind(self):
+        """
+        The :class:`WriteBehind` queue, started on first use in each process
+        and closed when it exits. `None` unless ``MONGODB_WRITE_BEHIND`` is
+        set, background writes are then sent right away.
+        """
+        if not self.app.config['MONGODB_WRITE_BEHIND']:
+            return None
+        if self._write_behind is None or \
+                self._write_behind_pid != os.getpid():
+            with self.lock:
+                if self._write_behind is None or \
+                        self._write_behind_pid != os.getpid():
+                    config = self.app.config
+                    self._write_behind = WriteBehind(
+                        self, config['MONGODB_WRITE_BEHIND_WORKERS'],
+                        config['MONGODB_WRITE_BEHIND_SIZE'])
+                    self._write_behind_pid = os.getpid()
+                    atexit.register(self._write_behind.close)
+        return self._write_behind
+
+    def run_async(self, func, *args, **kwargs):
+        """
+        Call `func` on :attr:`pool` and return its `AsyncResult`
+        """
+        def call():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                # worker threads live on, give their sockets back
+                for connection in self._open_connections():
+                    connection.end_request()
+        return self.pool.apply_async(call)
 
     def make_model(self):
         model = Model
@@ -264,22 +3119,285 @@ class MongoObject(object):
 
     @property
     def session(self):
-        if not getattr(self, "db", None):
-            self.db = self.connection[self.app.config['MONGODB_DATABASE']]
-            if self.app.config['MONGODB_AUTOREF']:
-                self.db.add_son_manipulator(NamespaceInjector())
-                self.db.add_son_manipulator(AutoReferenceObject(self))
-        return self.db
+        name = self.app.config['MONGODB_DATABASE']
+        connection = self.connection
+        db = self.db
+        if db is None or db.name != name or db.connection is not connection:
+            with self.lock:
+                db = self.db
+                if db is None or db.name != name or \
+                        db.connection is not connection:
+                    db = connection[name]
+                    self._add_manipulators(db)
+                    # other threads only see it with its manipulators
+                    self.db = db
+        return db
+
+    def get_session(self, bind=None):
+        """
+        The database of `bind`, :attr:`session` for the default one
+        """
+        if bind is None:
+            return self.session
+        name = self.get_bind(bind)['DATABASE']
+        connection = self.get_connection(bind)
+        db = self._sessions.get(bind, None)
+        if db is None or db.name != name or db.connection is not connection:
+            with self.lock:
+                db = self._sessions.get(bind, None)
+                if db is None or db.name != name or \
+                        db.connection is not connection:
+                    db = connection[name]
+                    self._add_manipulators(db)
+                    self._sessions[bind] = db
+        return db
+
+    def find_session(self, name):
+        """
+        The database called `name` of the first bind that has one, the
+        default bind first, or `None`
+        """
+        for bind in [None] + sorted(self.app.config['MONGODB_BINDS']):
+            if self.get_bind(bind)['DATABASE'] == name:
+                return self.get_session(bind)
+
+    def _add_manipulators(self, db):
+        if self.app.config['MONGODB_AUTOREF']:
+            if self.autoref is None:
+                self.autoref = AutoReferenceObject(self)
+            if self.app.config['MONGODB_STORE_NS']:
+                db.add_son_manipulator(NamespaceInjector())
+            db.add_son_manipulator(self.autoref)
+
+    @property
+    def identity_map(self):
+        """
+        Documents loaded during the current request, keyed by
+        `(database, collection, _id)`, so that binds with collections of the
+        same name don't share them. `None` when disabled or outside of a
+        request.
+        """
+        if not self.app.config['MONGODB_IDENTITY_MAP'] or \
+                _request_ctx_stack.top is None:
+            return None
+        try:
+            return self._local.identity_map
+        except AttributeError:
+            self._local.identity_map = {}
+            return self._local.identity_map
+
+    @property
+    def unit_of_work(self):
+        """
+        The :class:`UnitOfWork` of the current request. `None` when disabled
+        or outside of a request.
+        """
+        if not self.app.config['MONGODB_UNIT_OF_WORK'] or \
+                _request_ctx_stack.top is None:
+            return None
+        try:
+            return self._local.unit_of_work
+        except AttributeError:
+            self._local.unit_of_work = UnitOfWork()
+            return self._local.unit_of_work
+
+    def flush(self):
+        """
+        Send the writes queued so far in this request
+        """
+        unit = self.unit_of_work
+        if unit is not None:
+            unit.flush()
+
+    @property
+    def instrumented(self):
+        """
+        Whether operations are timed, to record them or to log slow ones
+        """
+        config = self.app.config
+        return config['MONGODB_RECORD_QUERIES'] or \
+            config['MONGODB_SLOW_QUERY_THRESHOLD'] is not None
+
+    def _request_stats(self):
+        if _request_ctx_stack.top is None:
+            return None
+        try:
+            return self._local.stats
+        except AttributeError:
+            self._local.stats = {'queries': [], 'conversion': 0.0,
+                                 'transform': 0.0}
+            return self._local.stats
+
+    def record(self, collection, operation, spec, duration, documents=None):
+        """
+        Record an operation sent to the server, see :class:`QueryRecord`
+        """
+        config = self.app.config
+        record = QueryRecord(collection, operation, _shape(spec), duration,
+                             documents)
+        if config['MONGODB_RECORD_QUERIES']:
+            stats = self._request_stats()
+            if stats is not None:
+                stats['queries'].append(record)
+            query_executed.send(self.app, record=record)
+        threshold = config['MONGODB_SLOW_QUERY_THRESHOLD']
+        if threshold is not None and duration >= threshold:
+            self.app.logger.warning('slow MongoDB %s on %s took %.1fms: %r',
+                                    operation, collection, duration * 1000,
+                                    record.spec)
+
+    def add_timing(self, kind, duration):
+        """
+        Add `duration` to the time spent in `kind`, either `'conversion'`
+        of documents to models or `'transform'` by the SON manipulators
+        """
+        if self.app.config['MONGODB_RECORD_QUERIES']:
+            stats = self._request_stats()
+            if stats is not None:
+                stats[kind] += duration
+
+    def get_debug_queries(self):
+        """
+        The :class:`QueryRecord` of every operation of the current request,
+        when ``MONGODB_RECORD_QUERIES`` is set
+        """
+        stats = self._request_stats()
+        return stats is not None and list(stats['queries']) or []
+
+    def get_request_stats(self):
+        """
+        Summary of the operations of the current request: their number,
+        total duration and documents, and the time spent converting and
+        transforming documents, durations being in seconds
+        """
+        stats = self._request_stats() or {'queries': [], 'conversion': 0.0,
+                                          'transform': 0.0}
+        queries = stats['queries']
+        return {'queries': len(queries),
+                'duration': sum(q.duration for q in queries),
+                'documents': sum(q.documents or 0 for q in queries),
+                'conversion': stats['conversion'],
+                'transform': stats['transform']}
 
     def set_mapper(self, model):
         # Set up mapper for model, so when ew retrieve documents from database,
         # we will know how to map them to model object based on `_ns` fields
         self.mapper[model.__collection__] = model
+        # models mapped once connected get their indexes right away, the
+        # others when the connection is opened
+        if self._connection is not None and self._pid == os.getpid():
+            self.schedule_indexes([model])
+
+    def schedule_indexes(self, models):
+        """
+        Ensure the :attr:`Model.__indexes__` of `models` on :attr:`pool`,
+        once per process, so that requests don't wait for them
+        """
+        if not self.app.config['MONGODB_ENSURE_INDEXES']:
+            return
+        models = [model for model in models if model.__indexes__ and
+                  model.__collection__ not in self._indexed]
+        if not models:
+            return
+        self._indexed.update(model.__collection__ for model in models)
+
+        def ensure():
+            try:
+                self.ensure_indexes(models)
+            except Exception:
+                self.app.logger.exception('could not ensure the indexes')
+        self.run_async(ensure)
+
+    def ensure_indexes(self, models=None):
+        """
+        Create the missing :attr:`Model.__indexes__` of `models`, all the
+        mapped models by default
+        """
+        for model in models or self.mapper.values():
+            collection = self.get_session(model.__bind__)[
+                model.__collection__]
+            for index in model.__indexes__:
+                key, options = _index_args(index)
+                collection.ensure_index(key, **options)
+
+    def strip_namespaces(self, models=None, batch_size=1000,
+                         background=True):
+        """
+        Remove the `_ns` field from the stored documents of `models`, all
+        the mapped models by default, `batch_size` documents at a time, to
+        move existing collections to ``MONGODB_STORE_NS = False``. Embedded
+        documents keep theirs.
+
+        Return the number of documents changed, or with `background` an
+        `AsyncResult` of it right away, the documents being changed on
+        :attr:`pool`.
+        """
+        def strip():
+            stripped = 0
+            for model in models or self.mapper.values():
+                collection = self.get_session(model.__bind__)[
+                    model.__collection__]
+                last = None
+                while True:
+                    # page by _id rather than scan again past the documents
+                    # already stripped
+                    spec = {'_ns': {'$exists': True}}
+                    if last is not None:
+                        spec['_id'] = {'$gt': last}
+                    ids = [document['_id'] for document in collection.find(
+                        spec, fields=['_id'], manipulate=False).sort(
+                        '_id', 1).limit(batch_size)]
+                    if not ids:
+                        if last is None:
+                            break
+                        # $gt only matches the _ids of the same type, start
+                        # again for those of other types
+                        last = None
+                        continue
+                    collection.update({'_id': {'$in': ids}},
+                                      {'$unset': {'_ns': 1}}, multi=True,
+                                      safe=True)
+                    stripped += len(ids)
+                    last = ids[-1]
+                if self.query_cache is not None:
+                    self.query_cache.invalidate(model.__collection__)
+            return stripped
+        if background:
+            return self.run_async(strip)
+        return strip()
 
     def close_connection(self, response):
-        self.connection.end_request()
+        try:
+            self.flush()
+            if response is not None and self.app.debug and \
+                    self.app.config['MONGODB_STATS_HEADER']:
+                stats = self.get_request_stats()
+                response.headers['X-MongoDB-Stats'] = \
+                    'queries=%d; duration=%.1fms; documents=%d; ' \
+                    'conversion=%.1fms; transform=%.1fms' % (
+                        stats['queries'], stats['duration'] * 1000,
+                        stats['documents'], stats['conversion'] * 1000,
+                        stats['transform'] * 1000)
+        finally:
+            self.release()
         return response
 
+    def teardown(self, exception):
+        self.release()
+
+    def release(self):
+        """
+        Forget the identity map, unit of work and recorded queries of the
+        current context, and give the sockets it reserved back to their
+        pools
+        """
+        release_local(self._local)
+        # don't connect just to give back a socket we never took
+        for connection in self._open_connections():
+            connection.end_request()
+
     def clear(self):
-        self.connection.drop_database(self.app.config['MONGODB_DATABASE'])
-        self.connection.end_request()
+        for bind in [None] + list(self.app.config['MONGODB_BINDS']):
+            connection = self.get_connection(bind)
+            connection.drop_database(self.get_bind(bind)['DATABASE'])
+            connection.end_request()
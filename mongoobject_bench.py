@@ -0,0 +1,322 @@
+"""
+Benchmarks of the document mapping hot paths, run without a live MongoDB
+
+The queries are answered in process by :class:`FakeConnection`, so what is
+measured is the decoding of the replies, the SON manipulators, the
+conversion of documents to models and the change tracking, not the network.
+
+Usage::
+
+    python mongoobject_bench.py                 # run and print the results
+    python mongoobject_bench.py --save          # store them as the baseline
+    python mongoobject_bench.py --compare       # fail on regressions
+
+The baseline, ``mongoobject_bench.json``, only means something on the
+machine that produced it: save it again before comparing on another one.
+"""
+import json
+import os
+import resource
+import struct
+import sys
+from optparse import OptionParser
+from timeit import default_timer
+
+import flask
+from bson import BSON
+from bson.dbref import DBRef
+from pymongo import Connection
+from flaskext.mongoobject import AttrDict, MongoObject
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'mongoobject_bench.json')
+
+#: name: (width, depth, list size, references) of the synthetic documents
+SHAPES = {
+    'flat': (10, 1, 0, 0),
+    'wide': (100, 1, 0, 0),
+    'deep': (5, 6, 0, 0),
+    'lists': (10, 1, 50, 0),
+    'refs': (10, 1, 0, 5),
+}
+
+DOCUMENTS = 500
+AUTHORS = 50
+
+
+class FakeConnection(Connection):
+    """
+    A connection answering queries from in-process collections, a dict of
+    collection name to list of documents. Only equality and `$in` on top
+    level fields, skip and limit are supported, everything is returned in
+    one batch.
+    """
+    def __init__(self, collections):
+        super(FakeConnection, self).__init__(_connect=False)
+        self.collections = {}
+        for name, documents in collections.iteritems():
+            self.collections[name] = [(d, BSON.encode(d)) for d in documents]
+
+    def _send_message_with_response(self, message, *args, **kwargs):
+        data = message[1]
+        pos = data.index('\x00', 20)
+        name = data[20:pos].split('.', 1)[1]
+        skip, limit = struct.unpack('<ii', data[pos + 1:pos + 9])
+        spec = BSON(data[pos + 9:]).decode()
+        spec = spec.get('$query', spec)
+
+        def match(document):
+            for key, value in spec.iteritems():
+                if isinstance(value, dict) and '$in' in value:
+                    if document.get(key) not in value['$in']:
+                        return False
+                elif document.get(key) != value:
+                    return False
+            return True
+
+        found = [raw for document, raw in self.collections.get(name, ())
+                 if match(document)][skip:]
+        if limit:
+            found = found[:abs(limit)]
+        return struct.pack('<iqii', 0, 0, 0, len(found)) + ''.join(found)
+
+
+def make_document(i, width, depth, list_size, refs):
+    def level(depth):
+        node = dict(('field%d' % n, 'value %d' % n) for n in xrange(width))
+        if depth > 1:
+            node['child'] = level(depth - 1)
+        return node
+
+    document = level(depth)
+    document.update({'_id': i, '_ns': 'documents'})
+    if list_size:
+        document['items'] = [{'value': n, 'name': 'item %d' % n}
+                             for n in xrange(list_size)]
+    if refs:
+        document['authors'] = [DBRef('authors', (i + n) % AUTHORS)
+                               for n in xrange(refs)]
+    return document
+
+
+def make_mongo(shape, references=None):
+    app = flask.Flask(__name__)
+    app.config.update(MONGODB_DATABASE='bench', MONGODB_AUTOREF=True)
+    mongo = MongoObject(app)
+
+    class Document(mongo.Model):
+        __collection__ = 'documents'
+        __references__ = references
+
+    class Author(mongo.Model):
+        __collection__ = 'authors'
+
+    mongo.set_mapper(Document)
+    mongo.set_mapper(Author)
+    documents = [make_document(i, *shape) for i in xrange(DOCUMENTS)]
+    authors = [{'_id': i, '_ns': 'authors', 'name': 'author %d' % i}
+               for i in xrange(AUTHORS)]
+    mongo.connection = FakeConnection({'documents': documents,
+                                       'authors': authors})
+    return mongo, Document
+
+
+# Each benchmark returns `setup` and `run`: `setup` builds the inputs of one
+# run, untimed, so that runs changing them in place don't leave the next ones
+# with nothing left to do, and `run` takes them and returns the number of
+# operations it did.
+def no_setup():
+    return None
+
+
+def bench_cursor_next(shape):
+    """Iterate over all the documents, in models"""
+    mongo, Document = make_mongo(shape)
+
+    def run(inputs):
+        for document in Document.query.find():
+            pass
+        return DOCUMENTS
+    return no_setup, run
+
+
+def bench_cursor_getitem(shape):
+    """Index a cursor, one query per item"""
+    mongo, Document = make_mongo(shape)
+    cursor = Document.query.find()
+
+    def run(inputs):
+        for i in xrange(0, DOCUMENTS, 10):
+            cursor[i]
+        return DOCUMENTS // 10
+    return no_setup, run
+
+
+def bench_transform_outgoing(shape, references=None):
+    """Apply the auto reference manipulator to raw documents"""
+    mongo, Document = make_mongo(shape, references)
+    collection = mongo.session['documents']
+    autoref = mongo.autoref
+
+    def setup():
+        # resolved in place
+        return [make_document(i, *shape) for i in xrange(DOCUMENTS)]
+
+    def run(raw):
+        for document in raw:
+            autoref.transform_outgoing(document, collection)
+        return DOCUMENTS
+    return setup, run
+
+
+def bench_transform_declared(shape):
+    """Same, the model declaring where its references are"""
+    return bench_transform_outgoing(shape, ('authors',))
+
+
+def bench_attrdict_setitem(shape):
+    """Change every field of loaded documents, with change tracking"""
+    width = shape[0]
+
+    def setup():
+        return [make_document(i, *shape) for i in xrange(DOCUMENTS)]
+
+    def run(raw):
+        for document in raw:
+            document = AttrDict(document)
+            document.mark_clean()
+            for n in xrange(width):
+                document['field%d' % n] = n
+        return len(raw) * width
+    return setup, run
+
+
+BENCHMARKS = {
+    'cursor_next': bench_cursor_next,
+    'cursor_getitem': bench_cursor_getitem,
+    'transform_outgoing': bench_transform_outgoing,
+    'transform_declared': bench_transform_declared,
+    'attrdict_setitem': bench_attrdict_setitem,
+}
+
+
+def measure(benchmark, shape, repeat):
+    """
+    Best throughput, in operations per second, of `repeat` runs, each on
+    fresh inputs, and the growth of the peak memory, in kilobytes, while
+    running them
+    """
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    setup, run = BENCHMARKS[benchmark](SHAPES[shape])
+    best = 0
+    for i in xrange(repeat):
+        inputs = setup()
+        start = default_timer()
+        operations = run(inputs)
+        best = max(best, operations / (default_timer() - start))
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'ops': best, 'peak_kb': after - before}
+
+
+def measure_apart(benchmark, shape, repeat):
+    """:func:`measure` in a child process, to isolate the peak memory"""
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        status = 0
+        try:
+            try:
+                result = measure(benchmark, shape, repeat)
+                os.write(write, json.dumps(result))
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                status = 1
+        finally:
+            os._exit(status)
+    os.close(write)
+    output = ''
+    while True:
+        chunk = os.read(read, 4096)
+        if not chunk:
+            break
+        output += chunk
+    os.close(read)
+    os.waitpid(pid, 0)
+    if not output:
+        raise RuntimeError('%s on %s failed' % (benchmark, shape))
+    return json.loads(output)
+
+
+def run_all(benchmarks, shapes, repeat):
+    results = {}
+    for benchmark in benchmarks:
+        for shape in shapes:
+            key = '%s/%s' % (benchmark, shape)
+            results[key] = measure_apart(benchmark, shape, repeat)
+            print '%-32s %12.0f ops/s %8d kB' % (
+                key, results[key]['ops'], results[key]['peak_kb'])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change of throughput against the `baseline`, and return the
+    benchmarks slower than it by more than `tolerance`
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        change = results[key]['ops'] / baseline[key]['ops'] - 1
+        print '%-32s %+7.1f%%' % (key, change * 100)
+        if change < -tolerance:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [benchmark...]')
+    parser.add_option('-s', '--shape', action='append', dest='shapes',
+                      choices=sorted(SHAPES), help='document shape to use, '
+                      'can be repeated. Defaults to all of them')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='runs of each benchmark, the best one counts')
+    parser.add_option('--save', action='store_true',
+                      help='store the results as the baseline')
+    parser.add_option('--compare', action='store_true',
+                      help='exit with an error when a benchmark is slower '
+                      'than the baseline by more than the tolerance')
+    parser.add_option('-t', '--tolerance', type='float', default=0.2,
+                      help='allowed slowdown, defaults to 0.2 (20%)')
+    parser.add_option('--baseline', default=BASELINE,
+                      help='baseline file, defaults to %default')
+    options, benchmarks = parser.parse_args(argv)
+    for benchmark in benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % benchmark)
+
+    results = run_all(benchmarks or sorted(BENCHMARKS),
+                      options.shapes or sorted(SHAPES), options.repeat)
+    if options.compare:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        if regressions:
+            print 'slower than the baseline: %s' % ', '.join(regressions)
+            return 1
+    if options.save:
+        # benchmarks that were not run keep their previous results
+        baseline = {}
+        if os.path.exists(options.baseline):
+            with open(options.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(options.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,26 @@
 from attest import Tests, assert_hook
+from bson import BSON
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+from bson.son import SON
+from datetime import datetime
 import flask
+import json
+import pickle
+import struct
+import sys
+import threading
+from werkzeug.exceptions import HTTPException
+from pymongo import Connection
+from pymongo.collection import Collection
+from pymongo.errors import InvalidOperation, OperationFailure
+from pymongo.son_manipulator import NamespaceInjector
 from flaskext.attest import request_context
-from flaskext.mongoobject import AttrDict, MongoObject
+from flaskext.mongoobject import AttrDict, AutoReferenceObject, LazyAttrDict, \
+    MongoObject, UnitOfWork, _QueryProperty, AsyncBaseQuery, BaseQuery, \
+    CompactDocument, compile_schema, LRUCache, Pagination, _keyset_spec, \
+    CollectionScanError, _index_args, WriteBehind, _merge_modifiers, dumps, \
+    stream_json, _reference_tree
 
 
 db = MongoObject()
@@ -16,6 +35,88 @@ class TestModel(db.Model):
 db.set_mapper(TestModel)
 
 
+class FakeCollection(object):
+    """In-memory stand-in for a collection that records the queries it gets"""
+    def __init__(self, name, documents=()):
+        self.name = name
+        self.documents = list(documents)
+        self.queries = []
+        self.projections = []
+
+    def find(self, spec=None, **kwargs):
+        spec = spec or {}
+        self.queries.append(spec)
+        self.projections.append(kwargs.get("fields"))
+        ids = spec.get("_id", {}).get("$in")
+        return [dict(d) for d in self.documents
+                if ids is None or d["_id"] in ids]
+
+
+class FakeQuery(object):
+    """Stand-in for :class:`BaseQuery` that records the writes it gets"""
+    name = "tests"
+    unit = None
+
+    def __init__(self, documents=(), mongo=None):
+        self.calls = []
+        self.documents = [TestModel(d) for d in documents]
+        self.mongo = mongo
+
+    def find(self, spec=None):
+        return iter([d for d in self.documents
+                     if all(d.get(k) == v for k, v in (spec or {}).items())])
+
+    def find_one(self, spec=None):
+        return next(self.find(spec), None)
+
+    @property
+    def unit_of_work(self):
+        if self.unit is not None and not self.unit.flushing:
+            return self.unit
+
+    def save(self, document, *args, **kwargs):
+        self.calls.append(("save", document["test"]))
+
+    def insert(self, documents, safe=False):
+        self.calls.append(("insert", [d["test"] for d in documents]))
+
+    def update(self, spec, document, *args, **kwargs):
+        self.calls.append(("update", spec, document))
+
+    def remove(self, spec):
+        self.calls.append(("remove", spec))
+
+    def prepare_changes(self, changes):
+        return changes
+
+
+def offline_mongo(**config):
+    """A :class:`MongoObject` with an app but no live connection"""
+    app = flask.Flask(__name__)
+    app.config.update(MONGODB_DATABASE="testdb", MONGODB_AUTOREF=False)
+    app.config.update(config)
+    mongo = MongoObject(app)
+    mongo.connection = Connection(_connect=False)
+    return mongo
+
+
+class FakeDatabase(dict):
+    name = "fakedb"
+
+
+class FakeMongo(object):
+    def __init__(self, *collections):
+        self.session = FakeDatabase((c.name, c) for c in collections)
+        self.mapper = {}
+        self.identity_map = None
+        self.instrumented = False
+        self.app = flask.Flask(__name__)
+        self.app.config["MONGODB_AUTOREF_DEPTH"] = None
+
+    def get_session(self, bind=None):
+        return self.session
+
+
 @request_context
 def setup_app():
     app.config['MONGODB_HOST'] = "mongodb://localhost:27017"
@@ -62,6 +163,935 @@ def convert_list():
     assert test.a[0] == "test"
 
 
+@mongounit.test
+def lazy_dict_should_convert_on_access():
+    raw = {"b": {"c": "d"}}
+    test = LazyAttrDict(a=raw, l=[{"e": "f"}])
+    assert dict.__getitem__(test, "a") is raw
+    assert test.a.b.c == "d"
+    assert isinstance(dict.__getitem__(test, "a"), AttrDict)
+    assert test.a is test.a
+    assert test.l[0].e == "f"
+    assert [item.e for item in test.l] == ["f"]
+
+
+class LazyModel(TestModel):
+    """Picklable, unlike models defined in a test"""
+    __lazy__ = True
+
+
+@mongounit.test
+def partly_accessed_lazy_model_should_pickle():
+    raw = BSON.encode({"_id": 1, "a": {"b": [{"c": 1}]}, "l": [{"x": 1}],
+                       "n": [[{"y": 1}]]})
+    test = LazyModel(BSON(raw).decode(as_class=SON))
+    test.l[0].x = 2
+    test.mark_clean()
+    for protocol in range(3):
+        copy = pickle.loads(pickle.dumps(test, protocol))
+        assert type(copy) is LazyModel
+        assert copy == test
+        assert copy.a.b[0].c == 1 and copy.n[0][0].y == 1
+        assert copy.get_changes() == {}
+        copy.l[0].x = 3
+        assert copy.get_changes() == {"$set": {"l": [{"x": 3}]}}
+
+
+@mongounit.test
+def prefetch_should_batch_references_per_collection():
+    users = FakeCollection("users", [{"_id": 1, "name": "a"},
+                                     {"_id": 2, "name": "b"}])
+    resolver = AutoReferenceObject(FakeMongo(users))
+    batch = [{"author": DBRef("users", 1)},
+             {"author": DBRef("users", 2), "editors": [DBRef("users", 1)]},
+             {"author": DBRef("users", 3)}]
+    resolver.prefetch(batch)
+    assert len(users.queries) == 1
+    assert batch[0]["author"]["name"] == "a"
+    assert batch[1]["editors"][0]["name"] == "a"
+    assert batch[2]["author"] is None
+
+
+@mongounit.test
+def prefetch_should_use_identity_map():
+    users = FakeCollection("users", [{"_id": 1, "name": "a"}])
+    mongo = FakeMongo(users)
+    mongo.identity_map = {
+        ("fakedb", "users", 1): TestModel(_id=1, name="cached")}
+    resolver = AutoReferenceObject(mongo)
+    batch = [{"author": DBRef("users", 1)}]
+    resolver.prefetch(batch)
+    assert not users.queries
+    assert batch[0]["author"] is mongo.identity_map[("fakedb", "users", 1)]
+
+
+@mongounit.test
+def prefetch_should_stop_at_cycles_and_depth():
+    users = FakeCollection("users", [
+        {"_id": 1, "_ns": "users", "name": "a", "friend": DBRef("users", 2)},
+        {"_id": 2, "_ns": "users", "name": "b", "friend": DBRef("users", 1)}])
+    mongo = FakeMongo(users)
+    mongo.mapper["users"] = TestModel
+    resolver = AutoReferenceObject(mongo)
+    batch = [{"_id": 1, "_ns": "users", "friend": DBRef("users", 2)}]
+    resolver.prefetch(batch, "users")
+    assert batch[0]["friend"].name == "b"
+    # back to the document it is nested in
+    assert batch[0]["friend"]["friend"] == DBRef("users", 1)
+
+    batch = [{"_id": 3, "author": DBRef("users", 1)}]
+    resolver.prefetch(batch, "posts", depth=1, fields={"author": ["name"]})
+    assert batch[0]["author"].is_partial
+    assert batch[0]["author"]["friend"] == DBRef("users", 2)
+    assert users.projections[-1] == ["_id", "_ns", "name"]
+
+
+@mongounit.test
+def references_should_share_one_instance_per_document():
+    mongo = FakeMongo()
+    mongo.mapper["tests"] = TestModel
+    mongo.identity_map = {}
+    resolver = AutoReferenceObject(mongo)
+    son = resolver.transform_outgoing({"a": {"_ns": "tests", "_id": 1},
+                                       "b": [{"_ns": "tests", "_id": 1}]},
+                                      None)
+    assert type(son["a"]) == TestModel
+    assert son["a"] is son["b"][0]
+
+
+@mongounit.test
+def only_reference_paths_should_be_visited():
+    users = FakeCollection("users", [{"_id": 1, "_ns": "users", "name": "a"}])
+    mongo = FakeMongo(users)
+
+    class Post(TestModel):
+        __collection__ = "posts"
+        __references__ = ("author", "comments.author")
+
+    mongo.mapper["users"] = TestModel
+    mongo.mapper["posts"] = Post
+    resolver = AutoReferenceObject(mongo)
+    body = {"nested": {"a": 1}}
+    post = {"_id": 1, "_ns": "posts", "author": DBRef("users", 1),
+            "comments": [{"author": DBRef("users", 1), "text": "x"}],
+            "other": DBRef("users", 1), "body": body}
+    son = resolver.transform_outgoing(post, FakeCollection("posts"))
+    assert son["author"].name == "a"
+    assert son["comments"][0]["author"].name == "a"
+    assert son["other"] == DBRef("users", 1)
+    assert son["body"] is body
+    assert len(users.queries) == 1
+
+    plain = {"_id": 2, "a": {"b": [1, 2]}}
+    assert resolver.transform_outgoing(plain, FakeCollection("tests")) \
+        is plain
+    assert _reference_tree({"a": [{"r": DBRef("users", 1)}, {"s": 1}],
+                            "b": {"_ns": "users"}, "c": 1}) == \
+        {"a": {"r": {}}, "b": {}}
+
+
+@mongounit.test
+def inferred_reference_paths_should_be_remembered_per_collection():
+    mongo = FakeMongo()
+    resolver = AutoReferenceObject(mongo)
+    resolver.inferred_sample = 2
+    first = resolver.reference_tree({"a": DBRef("users", 1)}, "tests")
+    assert first == {"a": {}}
+    second = resolver.reference_tree({"b": {"c": DBRef("users", 1)}}, "tests")
+    assert second == {"a": {}, "b": {"c": {}}}
+    assert first == {"a": {}}
+    assert resolver.reference_tree({"a": 1}, "tests") is second
+    assert resolver.reference_tree({"a": 1}, "tests") is second
+    # remembered, only one document in two is looked through now
+    assert resolver.reference_tree({"d": DBRef("users", 1)}, "tests") \
+        is second
+    assert resolver.reference_tree({"d": DBRef("users", 1)}, "tests") == \
+        {"a": {}, "b": {"c": {}}, "d": {}}
+    assert resolver.reference_tree({"e": DBRef("users", 1)}, None) == \
+        {"e": {}}
+
+
+@mongounit.test
+def should_track_changed_paths():
+    test = AttrDict({"a": {"b": "c", "d": "e"}, "l": [{"x": 1}], "gone": 1})
+    assert test.get_changes() is None
+    test.mark_clean()
+    assert test.get_changes() == {}
+    test.a.b = "changed"
+    test.l[0].x = 2
+    del test.gone
+    assert test.get_changes() == {"$set": {"a.b": "changed", "l": [{"x": 2}]},
+                                  "$unset": {"gone": 1}}
+    test.a = {"b": "new"}
+    assert test.get_changes()["$set"] == {"a": {"b": "new"},
+                                          "l": [{"x": 2}]}
+
+
+@mongounit.test
+def lazy_dict_should_track_changed_paths():
+    test = LazyAttrDict({"a": {"b": "c"}, "l": [{"x": 1}]})
+    test.mark_clean()
+    test.a.b = "changed"
+    test.l[0].x = 2
+    assert test.get_changes() == {"$set": {"a.b": "changed", "l": [{"x": 2}]}}
+
+
+@mongounit.test
+def dict_and_list_methods_should_be_tracked():
+    test = AttrDict({"a": {"b": 1}, "tags": ["x"], "k": 1, "n": {"m": 1},
+                     "l": [{"x": 1}]})
+    test.mark_clean()
+    test.a.update({"c": 2})
+    test.tags.append("y")
+    test.pop("k")
+    test.setdefault("d", 3)
+    test.setdefault("a", None)
+    test.n.clear()
+    test.l.append({"x": 2})
+    assert test.get_changes() == {
+        "$set": {"a.c": 2, "tags": ["x", "y"], "d": 3,
+                 "l": [{"x": 1}, {"x": 2}]},
+        "$unset": {"k": 1, "n.m": 1}}
+    test.mark_clean()
+    test.l[1].x = 3
+    assert test.get_changes() == {"$set": {"l": [{"x": 1}, {"x": 3}]}}
+
+    test = AttrDict({"m": [[1]]})
+    test.mark_clean()
+    test.m[0].append(2)
+    assert test.get_changes() == {"$set": {"m": [[1, 2]]}}
+
+    lazy = LazyAttrDict({"l": [{"x": 1}], "t": [1], "m": [[1]]})
+    lazy.mark_clean()
+    lazy.t.pop()
+    lazy.l[0].x = 2
+    lazy.m[0].append(2)
+    assert lazy.get_changes() == {"$set": {"l": [{"x": 2}], "t": [],
+                                           "m": [[1, 2]]}}
+
+
+@mongounit.test
+def referenced_models_should_track_their_own_changes():
+    author = TestModel(_id=1, name="a")
+    author.mark_clean()
+    post = TestModel(_id=2, title="t", author=author,
+                     authors=[author, {"_id": 3, "_ns": "tests"}])
+    post.mark_clean()
+    author.name = "b"
+    post.authors[1]["name"] = "c"
+    assert author.get_changes() == {"$set": {"name": "b"}}
+    assert post.get_changes() == {}
+    post.title = "new"
+    assert post.get_changes() == {"$set": {"title": "new"}}
+
+
+@mongounit.test
+def save_should_only_send_changes():
+    class Tracked(TestModel):
+        query = FakeQuery()
+
+    test = Tracked(_id=1, test="hello", other="world")
+    test.mark_clean()
+    test.save()
+    assert Tracked.query.calls == []
+    test.test = "changed"
+    test.save()
+    assert Tracked.query.calls == [("update", {"_id": 1},
+                                    {"$set": {"test": "changed"}})]
+    assert test.get_changes() == {}
+
+
+@mongounit.test
+def unit_of_work_should_group_writes():
+    class Queued(TestModel):
+        query = FakeQuery()
+    Queued.query.unit = unit = UnitOfWork()
+
+    first = Queued(test="first").save()
+    second = Queued(test="second").save()
+    assert first._id and second._id
+    second.test = "changed"
+    second.save()
+    existing = Queued(_id=1, test="existing")
+    existing.mark_clean()
+    existing.test = "changed"
+    existing.save(safe=True)
+    existing.other = "also changed"
+    existing.update()
+    method, options = unit.dirty["tests"][0][1:]
+    assert method == "save" and options["safe"] is True
+    gone = Queued(_id=2, test="gone")
+    gone.remove()
+    assert Queued.query.calls == []
+
+    unit.flush()
+    assert Queued.query.calls == [
+        ("insert", ["first", "changed"]),
+        ("update", {"_id": 1}, {"$set": {"test": "changed",
+                                         "other": "also changed"}}),
+        ("remove", {"_id": {"$in": [2]}})]
+    assert existing.get_changes() == {}
+
+
+@mongounit.test
+def unit_of_work_should_reference_new_models_across_collections():
+    mongo = offline_mongo(MONGODB_AUTOREF=True)
+    assert mongo.session
+    unit = UnitOfWork()
+
+    class Author(TestModel):
+        query = FakeQuery(mongo=mongo)
+    Author.query.name = "authors"
+    Author.query.unit = unit
+
+    class Post(TestModel):
+        query = FakeQuery(mongo=mongo)
+    Post.query.unit = unit
+
+    post = Post(test="post").save()
+    post.author = Author(test="author").save()
+    assert post.author._ns == "authors"
+    son = mongo.autoref.transform_incoming(post, None)
+    assert son["author"] == DBRef("authors", post.author._id)
+
+
+@mongounit.test
+def query_should_be_cached_per_database():
+    mongo = offline_mongo()
+
+    class Cached(TestModel):
+        query = _QueryProperty(mongo)
+
+    assert Cached.query is Cached.query
+    assert Cached.query.database.name == "testdb"
+    mongo.app.config['MONGODB_DATABASE'] = "otherdb"
+    assert Cached.query.database.name == "otherdb"
+    assert Cached.query is Cached.query
+
+
+@mongounit.test
+def should_connect_lazily_and_again_after_fork():
+    app = flask.Flask(__name__)
+    mongo = MongoObject(app)
+    assert mongo._connection is None
+    connections = []
+    mongo.connect = lambda: connections.append(1) or \
+        setattr(mongo, 'connection', Connection(_connect=False))
+    first = mongo.connection
+    assert mongo.connection is first
+    mongo._pid = -1
+    assert mongo.connection is not first
+    assert len(connections) == 2
+
+
+@mongounit.test
+def async_query_should_return_models_from_the_pool():
+    mongo = offline_mongo()
+    documents = [{"_id": i, "test": "hello"} for i in range(5)]
+
+    class Async(TestModel):
+        query = FakeQuery(documents, mongo)
+
+    assert isinstance(Async.aquery, AsyncBaseQuery)
+    found = Async.aquery.find_one({"_id": 3}).get(timeout=5)
+    assert type(found) == TestModel
+    assert found._id == 3
+    cursor = Async.aquery.find({"test": "hello"}, batch_size=2)
+    assert [item._id for item in cursor] == range(5)
+    test = Async(test="saved")
+    assert Async.aquery.save(test).get(timeout=5) is test
+    assert Async.query.calls == [("save", "saved")]
+
+
+@mongounit.test
+def cursor_should_yield_partial_models_in_batches():
+    database = Connection(_connect=False)["testdb"]
+    query = BaseQuery(database, "tests", document_class=TestModel)
+    cursor = query.find({}, ["test"])
+    # pretend the server already sent its only batch
+    cursor._Cursor__data = [{"_id": i, "test": "hello"} for i in range(5)]
+    cursor._Cursor__killed = True
+    batches = list(cursor.iter_batches(2))
+    assert [[item._id for item in batch] for batch in batches] == \
+        [[0, 1], [2, 3], [4]]
+    assert all(item.is_partial for batch in batches for item in batch)
+
+
+@mongounit.test
+def partial_model_should_load_missing_fields():
+    class Partial(TestModel):
+        query = FakeQuery([{"_id": 1, "test": "hello", "other": "world"}])
+
+    test = Partial(_id=1, test="changed")
+    test.mark_clean()
+    test.mark_partial(["test"])
+    assert test.other == "world"
+    assert test.test == "changed"
+    assert not test.is_partial
+    assert test.get_changes() == {}
+
+    test = Partial(_id=1, test="changed")
+    test.mark_partial(["test"])
+    try:
+        test.save()
+        assert False
+    except InvalidOperation:
+        assert Partial.query.calls == []
+
+
+@mongounit.test
+def compiled_schema_should_behave_like_attr_dict():
+    Post = compile_schema("Post", {"title": unicode,
+                                   "author": {"name": unicode},
+                                   "comments": [{"text": unicode}]})
+    post = Post({"title": "hello", "author": {"name": "a"},
+                 "comments": [{"text": "first"}], "extra": 1})
+    assert post.title == post["title"] == "hello"
+    assert isinstance(post.author, CompactDocument)
+    assert post.author.name == "a"
+    assert post.comments[0].text == "first"
+    assert post.extra == 1
+    assert "missing" not in post
+    assert post.to_son() == {"title": "hello", "author": {"name": "a"},
+                             "comments": [{"text": "first"}], "extra": 1}
+    assert sys.getsizeof(post) < sys.getsizeof(AttrDict(post.to_son()))
+
+
+@mongounit.test
+def model_with_schema_should_load_compact_documents():
+    class Compact(TestModel):
+        __schema__ = {"test": unicode}
+
+        def summary(self):
+            return self.test[:5]
+
+        @property
+        def shout(self):
+            return self.test.upper()
+
+    database = Connection(_connect=False)["testdb"]
+    query = BaseQuery(database, "tests", document_class=Compact)
+    assert query.document_class is Compact.schema_class()
+    assert query.document_class.model is Compact
+    assert TestModel.schema_class() is None
+    test = query.document_class({"_id": 1, "test": "hello"})
+    assert test.id == "1"
+    assert test.summary() == "hello"
+    assert test.shout == "HELLO"
+    assert type(test).__module__ == Compact.__module__
+    assert test.to_son().keys() == ["_id", "test"]
+
+
+@mongounit.test
+def lru_cache_should_evict_least_recently_used():
+    cache = LRUCache(threshold=2, default_timeout=0)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    cache.set("d", 4, timeout=-1)
+    assert cache.get("d") is None
+
+
+@mongounit.test
+def query_cache_should_serve_results_until_a_write():
+    mongo = offline_mongo()
+
+    class Cached(TestModel):
+        __cache__ = 30
+
+    query = BaseQuery(mongo.session, "tests", document_class=Cached,
+                      mongo=mongo)
+    cursor = query.find({"test": "hello", "other": 1})
+    mongo.query_cache.set("tests", cursor._cache_params(),
+                          [{"_id": 1, "test": "hello"}])
+    # the same spec built in another order uses the same entry
+    result = list(query.find({"other": 1, "test": "hello"}))
+    assert [type(item) for item in result] == [Cached]
+    assert result[0].test == "hello"
+    assert query.cache_timeout == 30
+    query.invalidate_cache()
+    assert mongo.query_cache.get("tests", cursor._cache_params()) is None
+
+    # a write while the results are read leaves them out of the cache
+    cursor = query.find({"test": "hello"})
+    cursor._read_cache()
+    query.invalidate_cache()
+    cursor._Cursor__data = [{"_id": 1, "test": "hello"}]
+    cursor._Cursor__killed = True
+    cursor._capture()
+    assert mongo.query_cache.get("tests", cursor._cache_params()) is None
+
+    # models that cache nothing don't touch the cache
+    plain = BaseQuery(mongo.session, "plain", document_class=TestModel,
+                      mongo=mongo)
+    plain.estimated_count = lambda: 3
+    assert plain.cached_count() == 3
+    plain.invalidate_cache()
+    assert mongo.query_cache.backend.get(
+        "flask-mongoobject:generation:plain") is None
+
+
+@mongounit.test
+def queries_should_be_recorded_per_request():
+    mongo = offline_mongo(MONGODB_RECORD_QUERIES=True,
+                          MONGODB_STATS_HEADER=True)
+    mongo.app.debug = True
+    assert mongo.instrumented
+    with mongo.app.test_request_context():
+        mongo.record("tests", "find", {"a": 1, "b": {"$in": [1, 2]}},
+                     0.002, 2)
+        mongo.add_timing("conversion", 0.001)
+        queries = mongo.get_debug_queries()
+        assert len(queries) == 1
+        assert queries[0].spec == {"a": "?", "b": {"$in": ["?"]}}
+        stats = mongo.get_request_stats()
+        assert stats["queries"] == 1
+        assert stats["documents"] == 2
+        response = mongo.app.response_class()
+        mongo.close_connection(response)
+        assert response.headers["X-MongoDB-Stats"].startswith("queries=1;")
+        assert mongo.get_debug_queries() == []
+    assert not offline_mongo().instrumented
+
+
+@mongounit.test
+def remove_should_evict_from_identity_map():
+    mongo = offline_mongo(MONGODB_IDENTITY_MAP=True)
+    query = BaseQuery(mongo.session, "tests", document_class=TestModel,
+                      mongo=mongo)
+    removed = []
+    query._timed = lambda operation, spec, documents, method, *args, \
+        **kwargs: removed.append(spec)
+    with mongo.app.test_request_context():
+        identity_map = mongo.identity_map
+        for key in [("testdb", "tests", 1), ("testdb", "tests", 2),
+                    ("testdb", "tests", 3), ("testdb", "users", 1),
+                    ("otherdb", "tests", 3)]:
+            identity_map[key] = TestModel(_id=key[2])
+        query.remove(1)
+        assert ("testdb", "tests", 1) not in identity_map
+        query.remove({"_id": {"$in": [2]}})
+        assert sorted(identity_map) == [("otherdb", "tests", 3),
+                                        ("testdb", "tests", 3),
+                                        ("testdb", "users", 1)]
+        query.remove({"test": "a"})
+        assert sorted(identity_map) == [("otherdb", "tests", 3),
+                                        ("testdb", "users", 1)]
+        assert removed == [1, {"_id": {"$in": [2]}}, {"test": "a"}]
+
+        identity_map[("testdb", "tests", 4)] = TestModel(_id=4)
+        identity_map[("testdb", "tests", 5)] = TestModel(_id=5)
+        query._timed = lambda operation, spec, documents, method, *args, \
+            **kwargs: TestModel(_id=4)
+        query.find_and_modify({"test": "b"}, remove=True)
+        assert ("testdb", "tests", 4) not in identity_map
+        assert ("testdb", "tests", 5) in identity_map
+        query.find_and_modify({"_id": 5}, {"$set": {"test": "c"}})
+        assert ("testdb", "tests", 5) in identity_map
+
+
+@mongounit.test
+def get_many_should_keep_the_order_of_the_ids():
+    mongo = offline_mongo(MONGODB_IDENTITY_MAP=True)
+    query = BaseQuery(mongo.session, "tests", document_class=TestModel,
+                      mongo=mongo)
+    query.get_many_chunk_size = 2
+    documents = dict((i, TestModel(_id=i)) for i in (1, 2, 3, 5))
+    specs = []
+
+    def find(spec, fields=None):
+        specs.append(spec["_id"]["$in"])
+        return [documents[i] for i in spec["_id"]["$in"] if i in documents]
+    query.find = find
+
+    with mongo.app.test_request_context():
+        mongo.identity_map[("testdb", "tests", 5)] = cached = \
+            TestModel(_id=5)
+        # the same collection in another database is another document
+        mongo.identity_map[("otherdb", "tests", 3)] = TestModel(_id=3)
+        items = query.get_many([3, 4, 1, 5, 3, 2])
+        assert [item and item._id for item in items] == [3, None, 1, 5, 3, 2]
+        assert items[3] is cached
+        assert specs == [[3, 4], [1, 2]]
+        assert query.get_many([1])[0] is items[2]
+        try:
+            query.get_many_or_404([1, 4])
+            assert False
+        except HTTPException, e:
+            assert e.code == 404
+
+
+@mongounit.test
+def page_should_range_on_the_sort_keys():
+    spec = _keyset_spec({"author": "a"}, [("date", -1), ("_id", 1)],
+                        [5, 2])
+    assert spec == {"author": "a", "$or": [{"date": {"$lt": 5}},
+                                           {"date": 5, "_id": {"$gt": 2}}]}
+    assert _keyset_spec({"_id": {"$ne": 1}}, [("_id", 1)], [2], False) == \
+        {"$and": [{"_id": {"$ne": 1}}, {"_id": {"$lt": 2}}]}
+
+    mongo = offline_mongo()
+    query = BaseQuery(mongo.session, "tests", document_class=TestModel,
+                      mongo=mongo)
+    calls = []
+
+    class Found(list):
+        def sort(self, order):
+            calls.append(order)
+            return self
+
+        def limit(self, limit):
+            return Found(self[:limit])
+
+    def find(spec=None, fields=None):
+        calls.append(spec)
+        return Found(TestModel(_id=i) for i in (1, 2, 3))
+    query.find = find
+
+    page = query.page(per_page=2)
+    assert [item._id for item in page] == [1, 2]
+    assert page.has_next and not page.has_prev
+    page = query.page(per_page=2, after=page.next_cursor)
+    assert calls[-2:] == [{"_id": {"$gt": 2}}, [("_id", 1)]]
+    assert page.has_prev
+    query.page(per_page=2, before=page.prev_cursor)
+    assert calls[-1] == [("_id", -1)]
+    assert Pagination([], 1, 20, 41).pages == 3
+
+
+@mongounit.test
+def indexes_should_be_declared_on_models():
+    assert _index_args("slug") == ([("slug", 1)], {"background": True})
+    key, options = _index_args({"key": [("author", 1), ("date", -1)],
+                                "unique": True, "expire_after": 60})
+    assert key == [("author", 1), ("date", -1)]
+    assert options == {"unique": True, "expireAfterSeconds": 60,
+                       "background": True}
+
+
+@mongounit.test
+def audit_should_refuse_collection_scans():
+    mongo = offline_mongo(MONGODB_EXPLAIN_AUDIT="error")
+    query = BaseQuery(mongo.session, "tests", document_class=TestModel,
+                      mongo=mongo)
+    explained = []
+
+    def explain():
+        explained.append(True)
+        return {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+
+    cursor = query.find({"test": "a"})
+    cursor.explain = explain
+    try:
+        cursor._audit()
+        assert False
+    except CollectionScanError:
+        pass
+    cursor = query.find({"test": "b"})
+    cursor.explain = explain
+    cursor._audit()
+    assert len(explained) == 1
+
+
+@mongounit.test
+def counts_should_be_cached_until_a_write():
+    mongo = offline_mongo()
+
+    class Counted(TestModel):
+        __cache_counts__ = True
+
+    query = BaseQuery(mongo.session, "tests", document_class=Counted,
+                      mongo=mongo)
+    counted = []
+
+    class Found(object):
+        def count(self):
+            counted.append("count")
+            return 3
+
+    query.find = lambda spec: Found()
+    query.estimated_count = lambda: counted.append("stats") or 10
+    assert query.cached_count({"test": "a"}) == 3
+    assert query.cached_count({"test": "a"}) == 3
+    assert query.cached_count() == 10
+    assert counted == ["count", "stats"]
+    query.invalidate_cache()
+    assert query.cached_count({"test": "a"}) == 3
+    assert counted == ["count", "stats", "count"]
+
+
+@mongounit.test
+def write_behind_should_coalesce_writes():
+    mongo = offline_mongo(MONGODB_WRITE_BEHIND=True)
+    writer = WriteBehind(mongo, workers=0)
+
+    class Counter(TestModel):
+        query = FakeQuery(mongo=mongo)
+
+    new = Counter(test="new")
+    writer.save(new)
+    assert new._id
+    new.test = "renamed"
+    writer.save(new)
+    counters = [Counter(_id=i, test="counter") for i in (1, 2)]
+    for counter in counters:
+        counter.mark_clean()
+        counter.views = 1
+        writer.save(counter)
+    counters[0].seen = "now"
+    writer.save(counters[0])
+    assert writer.count == 3
+    writer.flush()
+    assert Counter.query.calls == [
+        ("insert", ["renamed"]),
+        ("update", {"_id": 1}, {"$set": {"views": 1, "seen": "now"}}),
+        ("update", {"_id": 2}, {"$set": {"views": 1}})]
+    for counter in counters:
+        counter.views = 2
+        writer.update(counter)
+    threaded = WriteBehind(mongo, workers=1)
+    threaded.put(Counter.query, 3, "update", {"$set": {"views": 1}})
+    threaded.close()
+    writer.flush()
+    assert Counter.query.calls[3:] == [
+        ("update", {"_id": 3}, {"$set": {"views": 1}}),
+        ("update", {"_id": {"$in": [1, 2]}}, {"$set": {"views": 2}})]
+    assert _merge_modifiers({"$inc": {"views": 1}}, {"$inc": {"views": 2}}) \
+        == {"$inc": {"views": 3}}
+    assert _merge_modifiers({"$set": {"a": 1}}, {"$unset": {"a.b": 1}}) \
+        is None
+
+
+@mongounit.test
+def write_behind_should_queue_references_without_namespaces():
+    mongo = offline_mongo(MONGODB_AUTOREF=True, MONGODB_STORE_NS=False)
+    mongo.set_mapper(TestModel)
+    writer = WriteBehind(mongo, workers=0)
+
+    class Post(TestModel):
+        query = BaseQuery(mongo.session, "tests", document_class=TestModel,
+                          mongo=mongo)
+
+    post = Post(author=TestModel(_id=1, name="a"))
+    writer.save(post)
+    (query, writes), = writer.pending.values()
+    assert writes[0][0] == "insert"
+    assert writes[0][1]["author"] == DBRef("tests", 1)
+    assert "_ns" not in writes[0][1]
+
+
+@mongounit.test
+def models_should_serialize_to_json():
+    id = ObjectId("4e9c2b3f1d41c8125c000000")
+    Compact = compile_schema("Compact", {"name": None})
+    test = TestModel(_id=id, author=DBRef("users", id),
+                     when=datetime(2011, 10, 17), tags=["a"],
+                     extra=Compact(name="b"))
+    assert json.loads(dumps(test)) == {
+        "_id": str(id), "author": {"$ref": "users", "$id": str(id)},
+        "when": "2011-10-17T00:00:00", "tags": ["a"],
+        "extra": {"name": "b"}}
+
+    response = stream_json((TestModel(n=i) for i in range(5)), batch_size=2)
+    assert response.mimetype == "application/json"
+    chunks = list(response.response)
+    assert len(chunks) == 5
+    assert json.loads("".join(chunks)) == [{"n": i} for i in range(5)]
+    assert "".join(stream_json([]).response) == "[]"
+
+
+@mongounit.test
+def aggregate_should_stream_batches_of_models():
+    mongo = offline_mongo()
+    mongo.set_mapper(TestModel)
+    query = BaseQuery(mongo.session, "tests", document_class=TestModel,
+                      mongo=mongo)
+    sent = []
+
+    def reply(**options):
+        return {"ok": 1, "cursor": {"id": 42, "ns": "testdb.tests",
+                                    "firstBatch": [{"_id": "a", "n": 2},
+                                                   {"_id": 1, "_ns": "tests"}]}}
+
+    def find_one(collection, command, **kwargs):
+        sent.append((collection.name, dict(command), kwargs["manipulate"]))
+        return reply()
+
+    def send(message, **kwargs):
+        sent.append("getmore")
+        return struct.pack("<iqii", 0, 0, 0, 1) + BSON.encode({"_id": "b"})
+
+    mongo.connection._send_message_with_response = send
+    pipeline = [{"$group": {"_id": "$author", "n": {"$sum": 1}}}]
+    cursor = query.aggregate(pipeline, batch_size=2, allow_disk_use=True)
+    assert sent == []
+    original, Collection.find_one = Collection.find_one, find_one
+    try:
+        results = list(cursor)
+    finally:
+        Collection.find_one = original
+    assert sent == [("$cmd", {"aggregate": "tests", "pipeline": pipeline,
+                              "cursor": {"batchSize": 2},
+                              "allowDiskUse": True}, False), "getmore"]
+    assert [type(r) for r in results] == [AttrDict, TestModel, AttrDict]
+    assert results[0].n == 2 and results[2]._id == "b"
+
+    closed = []
+    mongo.connection.close_cursor = closed.append
+    cursor = query.aggregate(pipeline, as_class=TestModel)
+    cursor._command = reply
+    assert type(next(cursor)) is TestModel
+    cursor.close()
+    assert closed == [42]
+
+    def old_server(**options):
+        if options:
+            raise OperationFailure("unrecognized field 'cursor'")
+        return {"ok": 1, "result": [{"_id": "a", "n": 2}]}
+
+    cursor = query.aggregate(pipeline, batch_size=2)
+    cursor._command = old_server
+    assert [r.n for r in cursor] == [2]
+
+
+@mongounit.test
+def models_should_be_routed_to_their_bind():
+    mongo = offline_mongo(MONGODB_BINDS={"stats": {"DATABASE": "statsdb"}})
+    opened = []
+    mongo.open_connection = lambda bind: opened.append(bind) or \
+        Connection(_connect=False)
+
+    class Stat(TestModel):
+        __collection__ = "stats"
+        __bind__ = "stats"
+        query = _QueryProperty(mongo)
+
+    mongo.set_mapper(Stat)
+    assert Stat.query.database.name == "statsdb"
+    assert Stat.query.database.connection is not mongo.connection
+    assert Stat.query is Stat.query
+    assert opened == ["stats"]
+
+    resolver = AutoReferenceObject(mongo)
+    son = resolver.transform_incoming({"stat": {"_id": 1, "_ns": "stats"}},
+                                      mongo.session["tests"])
+    assert son["stat"] == DBRef("stats", 1, "statsdb")
+    statsdb = mongo.get_session("stats")
+    assert resolver._database(DBRef("stats", 1), mongo.session) is statsdb
+    assert resolver._database(DBRef("logs", 1, "statsdb"),
+                              mongo.session) is statsdb
+    assert resolver._database(DBRef("logs", 1, "nowhere"),
+                              mongo.session) is None
+    try:
+        mongo.get_session("missing")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("unknown binds should be refused")
+
+
+@mongounit.test
+def namespaces_should_not_be_stored_when_disabled():
+    mongo = offline_mongo(MONGODB_AUTOREF=True, MONGODB_STORE_NS=False)
+    mongo.set_mapper(TestModel)
+    session = mongo.session
+    assert mongo.autoref is not None
+    assert not any(isinstance(m, NamespaceInjector) for m in
+                   session._Database__incoming_manipulators)
+    author = TestModel(_id=1, _ns="tests", name="a")
+    son = mongo.autoref.transform_incoming(
+        {"_id": 2, "_ns": "tests", "author": author,
+         "others": [TestModel(_id=3)], "draft": TestModel(name="b")},
+        session["tests"])
+    assert "_ns" not in son
+    assert son["author"] == DBRef("tests", 1)
+    assert son["others"] == [DBRef("tests", 3)]
+    assert son["draft"] == {"name": "b"}
+
+    updates = []
+    starts = []
+
+    class Found(list):
+        def sort(self, key, direction):
+            assert key == "_id" and direction == 1
+            return self
+
+        def limit(self, size):
+            return self[:size]
+
+    class Collection(object):
+        left = [4, 0, 2, 3, 1]
+
+        def find(self, spec, fields=None, manipulate=True):
+            assert spec["_ns"] == {"$exists": True}
+            start = spec.get("_id", {}).get("$gt")
+            starts.append(start)
+            return Found({"_id": i} for i in sorted(self.left)
+                         if start is None or i > start)
+
+        def update(self, spec, document, multi=False, safe=False):
+            assert multi and safe
+            updates.append(spec["_id"]["$in"])
+            self.left = [i for i in self.left if i not in spec["_id"]["$in"]]
+
+    mongo.get_session = lambda bind: {"tests": Collection()}
+    assert mongo.strip_namespaces(batch_size=2, background=False) == 5
+    assert updates == [[0, 1], [2, 3], [4]]
+    # each batch starts after the last one, and the last query finds nothing
+    assert starts == [None, 1, 3, 4, None]
+
+
+@mongounit.test
+def session_should_be_set_up_once_across_threads():
+    mongo = offline_mongo(MONGODB_AUTOREF=True, MONGODB_IDENTITY_MAP=True)
+    sessions = []
+    threads = [threading.Thread(target=lambda: sessions.append(mongo.session))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(sessions) == 8
+    assert all(session is sessions[0] for session in sessions)
+    assert len(sessions[0]._Database__incoming_manipulators) == 2
+    assert len(sessions[0]._Database__incoming_copying_manipulators) == 1
+
+    ended = []
+    mongo.connection.end_request = lambda: ended.append(1)
+
+    @mongo.app.route("/fail")
+    def fail():
+        mongo.identity_map["x"] = 1
+        raise ValueError("failed")
+
+    mongo.app.testing = False
+    assert mongo.app.test_client().get("/fail").status_code == 500
+    assert ended
+    with mongo.app.test_request_context():
+        assert mongo.identity_map == {}
+
+
+@mongounit.test
+def lock_should_be_replaced_once_after_fork():
+    mongo = offline_mongo()
+    inherited = mongo.lock
+    assert mongo.lock is inherited
+    mongo._lock_pid = -1
+    locks = []
+    threads = [threading.Thread(target=lambda: locks.append(mongo.lock))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(locks) == 8
+    assert locks[0] is not inherited
+    assert all(lock is locks[0] for lock in locks)
+
+
 @mongointegration.test
 def setup_database_properly(client):
     assert db.app
@@ -157,5 +1187,18 @@ def should_update():
     assert parent.hello == "test"
     assert parent.test == "Hello"
 
+@mongointegration.test
+def should_return_same_instance_from_identity_map(client):
+    app.config['MONGODB_IDENTITY_MAP'] = True
+    try:
+        id = db.session.tests.insert({"test": "hello world"})
+        first = TestModel.query.find_one(id)
+        assert TestModel.query.get_or_404(id) is first
+        assert TestModel.query.find_one({"test": "hello world"}) is first
+        db.close_connection(None)
+        assert TestModel.query.find_one(id) is not first
+    finally:
+        app.config['MONGODB_IDENTITY_MAP'] = False
+
 if __name__ == '__main__':
     flask_mongoobject.run()